@@ -17,6 +17,12 @@ Self Consistent field class
     HubbardHamiltonian
     NEGF
     calc_n
+    calc_n_batched
+    calc_n_kpm
+    calc_n_purification
+    converge_ensemble
+    Telemetry
+    MixerFallback
 
 Read and write in binary files
 ==============================
@@ -54,5 +60,10 @@ from . import plot
 from .sp2 import *
 from .ncsile import *
 from .density import *
+from .kpm import *
+from .purification import *
+from .ensemble import *
 from .negf import *
+from .telemetry import *
+from .fallback import *
 from .grid import *
@@ -1,11 +1,280 @@
+import os
 import numpy as np
 from numpy import einsum, conj
 import sisl
+from scipy.sparse import coo_matrix
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from hubbard.telemetry import _timer, _record
 
-__all__ = ['calc_n', 'calc_n_insulator']
+__all__ = ['calc_n', 'calc_n_insulator', 'calc_n_batched']
 
 
-def calc_n(H, q):
+def _get_executor(executor, max_workers=None):
+    """ Return an executor instance and whether it has been created here (and thus needs to be shut down)
+
+    Parameters
+    ----------
+    executor: None, str or concurrent.futures.Executor
+        ``None`` for serial execution, ``'thread'`` or ``'process'`` to create a pool
+        or an already existing `concurrent.futures.Executor` instance
+    max_workers: int, optional
+        number of workers for the pool created here
+    """
+    if executor is None or isinstance(executor, Executor):
+        return executor, False
+    if executor == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers), True
+    elif executor == 'process':
+        return ProcessPoolExecutor(max_workers=max_workers), True
+    raise ValueError(f"executor must be None, 'thread', 'process' or a concurrent.futures.Executor instance, got {executor}")
+
+
+def _map_kpoints(func, H, tasks, executor=None, max_workers=None):
+    """ Evaluate `func` for each (k, weight, spin, ...) task, optionally distributed over the workers of an executor
+
+    The tasks are distributed in contiguous chunks (to reduce the communication with the workers)
+    and the results are returned in the same order as `tasks`. This ensures that the reduction
+    performed by the caller is deterministic and independent of the number of workers.
+    """
+    executor, shutdown = _get_executor(executor, max_workers)
+    if executor is None:
+        return _map_chunk(func, H, tasks)
+
+    try:
+        # The number of workers is not exposed by executors, the pools created without max_workers use about one per CPU
+        nworkers = max_workers or os.cpu_count() or 1
+        # Use a few chunks per worker to balance the load
+        nchunks = min(len(tasks), 4 * nworkers)
+        bounds = np.linspace(0, len(tasks), nchunks + 1).astype(int)
+        futures = [executor.submit(_map_chunk, func, H, tasks[i:j]) for i, j in zip(bounds[:-1], bounds[1:])]
+        out = []
+        for f in futures:
+            out.extend(f.result())
+    finally:
+        if shutdown:
+            executor.shutdown()
+    return out
+
+
+def _map_chunk(func, H, tasks):
+    # Needs to be a module function so it can be sent to process pools
+    return [func(H, *task) for task in tasks]
+
+
+def _eigh_task(H, k, spin, select, eigvals_only=False):
+    # Bypass the eigen-cache (the results are stored by the calling process)
+    if eigvals_only:
+        return H._eigh_solve(k, spin, eigvals_only=True, select=select), None
+    return H._eigh_solve(k, spin, eigvals_only=False, select=select)
+
+
+def _density_task(H, k, spin, occ):
+    # Density and band energy of (k, spin) for the occupations `occ`, reduced here such that
+    # only the eigenvectors of one k-point per worker are held at a time
+    eig, evec = H._eigh_solve(k, spin, eigvals_only=False)
+    es = sisl.physics.electron.EigenstateElectron(evec.T, eig, H.H, k=k, gauge='R', spin=spin)
+    return einsum('i,ij->j', occ, es.norm2(False).real), eig.dot(occ)
+
+
+def _eigh_kpoints(H, executor=None, max_workers=None, select=None, eigvals_only=False):
+    """ Ensure the eigen-decomposition of all (k, spin) pairs of ``H.mp`` is in the eigen-cache of `H`
+
+    Only the pairs that are not already stored are solved, optionally distributed over the workers of `executor`.
+
+    Parameters
+    ----------
+    select: list of (int, int), optional
+        per spin, only solve for the eigenpairs in the index range ``[start, stop)``
+    eigvals_only: bool, optional
+        only the eigenvalues are required (the eigenvectors of the pairs are then ``None``)
+
+    Returns
+    -------
+    list
+        ``(eig, evec)`` pairs indexed as ``[ik][spin]``. The pairs are kept by the caller, so the
+        k-points are diagonalized only once even if the eigen-cache cannot hold all of them
+    """
+    if select is None:
+        select = [(0, H.sites)] * H.spin_size
+    revision = H._eig_revision()
+    tasks = [(k, s, select[s], eigvals_only) for k in H.mp.k for s in range(H.spin_size)]
+    entries = [H._eig_cache.get(H._eig_key(k, s, revision), sel, eigvals_only) for k, s, sel, _ in tasks]
+    missing = [i for i, entry in enumerate(entries) if entry is None]
+    if executor is not None and len(missing) > 1:
+        for i, (eig, evec) in zip(missing, _map_kpoints(_eigh_task, H, [tasks[i] for i in missing], executor, max_workers)):
+            k, s, sel, _ = tasks[i]
+            H._eig_cache.put(H._eig_key(k, s, revision), eig, evec, start=sel[0])
+            entries[i] = (eig, evec)
+    else:
+        for i in missing:
+            k, s, sel, _ = tasks[i]
+            entries[i] = H._eigh(k, s, eigvals_only=eigvals_only, revision=revision, select=sel)
+    return [[entries[ik * H.spin_size + s] for s in range(H.spin_size)] for ik in range(len(H.mp.k))]
+
+
+def _Pk_stack(H, k, dim=0):
+    """ Bloch matrices of the ``dim`` component of ``H.H`` for all `k` as a contiguous ``(nk, no, no)`` array
+
+    The supercell matrices are assembled once as a dense ``(n_s, no * no)`` array so the
+    phases of all k-points are applied with a single matrix product.
+    """
+    no = H.sites
+    coo = H.H.tocsr(dim).tocoo()
+    isc, col = np.divmod(coo.col, no)
+    P = coo_matrix((coo.data, (isc, coo.row * no + col)), shape=(H.H.geometry.n_s, no * no)).toarray()
+    phase = np.exp(2j * np.pi * np.asarray(k, dtype=np.float64).reshape(-1, 3) @ H.H.geometry.sc_off.T)
+    if np.allclose(phase.imag, 0, rtol=0, atol=1e-12):
+        # Real Bloch matrices (Gamma or zone-boundary k-points)
+        phase = phase.real
+    return (phase @ P).reshape(-1, no, no)
+
+
+def _eigh_stack(H, k, spin):
+    """ Solve the eigenvalue problems of all `k` for `spin` with stacked LAPACK calls
+
+    Returns
+    -------
+    eig: numpy.ndarray
+        eigenvalues with shape ``(nk, no)``
+    evec: numpy.ndarray
+        eigenvectors with shape ``(nk, no, no)``, ``evec[ik, :, i]`` corresponds to ``eig[ik, i]``
+    """
+    Hk = _Pk_stack(H, k, spin)
+    if H.H.orthogonal:
+        return np.linalg.eigh(Hk)
+    # Reduce the generalized problem to a standard one through the Cholesky factorization S = L L^H
+    Linv = np.linalg.inv(np.linalg.cholesky(_Pk_stack(H, k, H.H.S_idx)))
+    LinvH = conj(Linv.transpose(0, 2, 1))
+    eig, evec = np.linalg.eigh(Linv @ Hk @ LinvH)
+    return eig, LinvH @ evec
+
+
+def _fermi_level(eig, weight, q, distribution, q_tol=1e-10):
+    """ Find the Fermi level(s) by bisection from the eigenvalues of a k-point sampling
+
+    Parameters
+    ----------
+    eig: numpy.ndarray
+        eigenvalues with shape ``(nk, spin, no)``
+    weight: numpy.ndarray
+        k-point weights
+    q: array_like
+        charge per spin channel. If only one value is passed for a spin-polarized system
+        a common Fermi level is found for both spin channels
+    distribution: callable
+        distribution function accepting the keyword ``mu``
+    q_tol: float, optional
+        tolerance of the charge
+
+    Returns
+    -------
+    float or numpy.ndarray
+        a Fermi level per spin channel if ``len(q) == 2``, otherwise a single one
+    """
+    q = np.asarray(q, dtype=np.float64).ravel()
+    w = np.asarray(weight).reshape(-1, 1)
+
+    def _Ef(q, eig):
+        min_Ef, max_Ef = eig.min(), eig.max()
+        Ef = (min_Ef + max_Ef) * 0.5
+        while np.nextafter(min_Ef, max_Ef) < max_Ef:
+            qt = (distribution(eig, mu=Ef) * w).sum()
+            if abs(qt - q) < q_tol:
+                return Ef
+            if qt >= q:
+                max_Ef = Ef
+            elif qt <= q:
+                min_Ef = Ef
+            Ef = (min_Ef + max_Ef) * 0.5
+        return Ef
+
+    if eig.shape[1] == 2 and q.size == 2:
+        return np.array([_Ef(q[s], eig[:, s]) for s in range(2)])
+    return _Ef(q.sum(), eig.reshape(eig.shape[0], -1))
+
+
+def _fermi_dirac(eig, weight, q, kT, q_tol=1e-10, max_iter=500):
+    r""" Find the Fermi level(s) of the Fermi-Dirac distribution and the corresponding occupations in the same pass
+
+    The charge :math:`N(\mu) = \sum_k w_k \sum_i f_\mu(\epsilon_{ik})` is monotonic in :math:`\mu` and its derivative
+    is known analytically, :math:`N'(\mu) = \sum_k w_k \sum_i f_\mu(1-f_\mu)/k_BT`.
+    The root of :math:`N(\mu) - q` is thus found with Newton steps, safeguarded by a bracket
+    (bisection is used when a Newton step leaves the bracket or does not reduce it fast enough, e.g., in a gap at low temperature).
+    The iterations start from the zero temperature estimate, obtained from the sorted eigenvalues.
+
+    Parameters
+    ----------
+    eig: numpy.ndarray
+        eigenvalues with shape ``(nk, spin, nbands)``
+    weight: numpy.ndarray
+        k-point weights
+    q: array_like
+        charge per spin channel. If only one value is passed for a spin-polarized system
+        a common Fermi level is found for both spin channels
+    kT: float
+        temperature (in energy units)
+    q_tol: float, optional
+        tolerance of the charge
+
+    Returns
+    -------
+    Ef: numpy.ndarray
+        Fermi level per spin channel
+    occ: numpy.ndarray
+        occupations (not multiplied by the k-point weights) with the same shape as `eig`
+    """
+    q = np.asarray(q, dtype=np.float64).ravel()
+    w = np.asarray(weight, dtype=np.float64).reshape(-1, 1)
+    kT = max(kT, 1e-300)
+
+    def fermi(e, mu):
+        return 0.5 * (1. - np.tanh((e - mu) / (2 * kT)))
+
+    def solve(q, e):
+        # Zero temperature estimate
+        idx = np.argsort(e, axis=None)
+        es = e.ravel()[idx]
+        cum = np.cumsum(np.broadcast_to(w, e.shape).ravel()[idx])
+        i = min(np.searchsorted(cum, q - q_tol), len(es) - 1)
+        mu = 0.5 * (es[i] + es[min(i + 1, len(es) - 1)])
+
+        lo, hi = es[0] - 50 * kT, es[-1] + 50 * kT
+        dmu_old = hi - lo
+        for _ in range(max_iter):
+            f = fermi(e, mu)
+            dq = (f * w).sum() - q
+            if abs(dq) < q_tol:
+                break
+            if dq > 0:
+                hi = mu
+            else:
+                lo = mu
+            if np.nextafter(lo, hi) >= hi:
+                break
+            dN = (f * (1 - f) * w).sum() / kT
+            mu_new = mu - dq / dN if dN > 0 else lo - 1.
+            if not lo < mu_new < hi or abs(mu_new - mu) > 0.5 * dmu_old:
+                # Bisection
+                mu_new = 0.5 * (lo + hi)
+            dmu_old = abs(mu_new - mu)
+            mu = mu_new
+        else:
+            f = fermi(e, mu)
+        return mu, f
+
+    occ = np.empty_like(eig, dtype=np.float64)
+    if eig.shape[1] == 2 and q.size == 2:
+        Ef = np.empty(2)
+        for s in range(2):
+            Ef[s], occ[:, s] = solve(q[s], eig[:, s])
+    else:
+        Ef, f = solve(q.sum(), eig.reshape(eig.shape[0], -1))
+        occ[...] = f.reshape(eig.shape)
+        Ef = np.full(eig.shape[1], Ef)
+    return Ef, occ
+
+
+def calc_n(H, q, executor=None, max_workers=None):
     r""" General method to obtain the spin densities for periodic or finite systems at a given temperature
 
     It obtains the spin densities from the direct diagonalization of the Hamiltonian (``H.H``) taking into account
@@ -23,71 +292,163 @@ def calc_n(H, q):
         `hubbard.HubbardHamiltonian` object of the system to obtain the spin-densities from
     q: array_like
         charge resolved in spin channels (first index for up-electrons and second index for down-electrons)
+    executor: str or concurrent.futures.Executor, optional
+        distribute the (k, spin) eigenvalue problems over the workers of an executor.
+        ``'thread'`` creates a thread pool (efficient since the diagonalization releases the GIL),
+        ``'process'`` a process pool. Both are created (and shut down) at each call, so for
+        SCF loops it is more efficient to pass an executor instance, e.g.,
+        ``H.converge(calc_n, func_args={'executor': ThreadPoolExecutor(4)})``.
+        Defaults to serial execution
+    max_workers: int, optional
+        number of workers if the executor is created from a string. For an existing executor it is used to
+        split the k-points in chunks (defaults to the number of CPUs)
+
+    Notes
+    -----
+    Each k-point is diagonalized once if the eigenvectors of all k-points (``nk * no**2`` complex numbers per spin)
+    fit in the eigen-cache (see `hubbard.HubbardHamiltonian.set_eigen_cache`). Otherwise the eigenvalues
+    are obtained first and then the eigenvectors of one k-point at a time (per worker), which diagonalizes twice
+    but keeps the memory independent of the number of k-points.
 
     See Also
     ------------
     sisl.physics.electron.EigenstateElectron.norm2: sisl routine to obtain the dot product of the eigenstates with the overlap matrix
     """
-    # Create fermi-level determination distribution
-    dist = sisl.get_distribution('fermi_dirac', smearing=H.kT)
-    Ef = H.H.fermi_level(H.mp, q=q, distribution=dist)
-    if not isinstance(Ef, (tuple, list, np.ndarray)):
-        Ef = np.array([Ef])
-    dist = [sisl.get_distribution('fermi_dirac', smearing=H.kT, x0=Ef[s]) for s in range(H.spin_size)]
-
-    ni = np.zeros((H.spin_size, H.sites))
-    Etot = 0
+    # The eigenvectors of all k-points are only held at once if they fit in the eigen-cache
+    stream = len(H.mp.k) * H.spin_size * H.sites ** 2 * 16 > H._eig_cache.max_memory
 
-    # Solve eigenvalue problems
-    def calc_occ(k, weight, spin):
-        n = np.empty_like(ni)
-        es = H.eigenstate(k, spin=spin)
+    # Solve eigenvalue problems for all k-points (stored in the eigen-cache), exactly once per call
+    with _timer(H, 'eigen'):
+        entries = _eigh_kpoints(H, executor, max_workers, eigvals_only=stream)
+    eig = np.array([[e for e, _ in entry] for entry in entries])
 
-        # Reduce to occupied stuff
-        occ = es.occupation(dist[spin]) * weight
-        n = einsum('i,ij->j', occ, es.norm2(False).real)
+    # Fermi level(s) and occupations from the eigenvalues
+    with _timer(H, 'fermi'):
+        Ef, occ = _fermi_dirac(eig, H.mp.weight, q, H.kT)
+    _record(H, Ef=Ef)
 
-        Etot = es.eig.dot(occ)
+    ni = np.zeros((H.spin_size, H.sites))
+    Etot = 0
 
-        # Return values
-        return n, Etot
+    if stream:
+        # Eigenvectors one k-point at a time, reduced to the densities by the workers
+        tasks = [(k, s, occ[ik, s] * w) for ik, (w, k) in enumerate(zip(H.mp.weight, H.mp.k)) for s in range(H.spin_size)]
+        with _timer(H, 'eigen'):
+            results = _map_kpoints(_density_task, H, tasks, executor, max_workers)
+        for (_, s, _), (ni_ks, Etot_ks) in zip(tasks, results):
+            ni[s] += ni_ks
+            Etot += Etot_ks
+        return ni, (2./H.spin_size)*Etot
 
     # Loop k-points and weights
-    for w, k in zip(H.mp.weight, H.mp.k):
+    for ik, [w, k] in enumerate(zip(H.mp.weight, H.mp.k)):
         for s in range(H.spin_size):
-            n, etot = calc_occ(k, w, s)
-            ni[s] += n
-            Etot += etot
+            eig_ks, evec = entries[ik][s]
+            es = sisl.physics.electron.EigenstateElectron(evec.T, eig_ks, H.H, k=k, gauge='R', spin=s)
+
+            # Reduce to occupied stuff
+            occ_ks = occ[ik, s] * w
+            ni[s] += einsum('i,ij->j', occ_ks, es.norm2(False).real)
+            Etot += es.eig.dot(occ_ks)
 
     # Return spin densities and total energy
     # if the Hamiltonian is not spin-polarized multiply Etot by 2 for spin degeneracy
     return ni, (2./H.spin_size)*Etot
 
 
-def calc_n_insulator(H, q):
-    """ Method to obtain the spin-densities only for the corner case for *insulators* at *T=0* """
+def calc_n_insulator(H, q, executor=None, max_workers=None):
+    """ Method to obtain the spin-densities only for the corner case for *insulators* at *T=0*
+
+    Parameters
+    ----------
+    H: HubbardHamiltonian
+        `hubbard.HubbardHamiltonian` object of the system to obtain the spin-densities from
+    q: array_like
+        charge resolved in spin channels (first index for up-electrons and second index for down-electrons)
+    executor: str or concurrent.futures.Executor, optional
+        distribute the (k, spin) eigenvalue problems over the workers of an executor, see `calc_n`
+    max_workers: int, optional
+        number of workers if the executor is created from a string. For an existing executor it is used to
+        split the k-points in chunks (defaults to the number of CPUs)
+    """
     ni = np.zeros((H.spin_size, H.sites))
     Etot = 0
 
-    idx = [np.arange(int(round(q[s]))) for s in range(H.spin_size)]
+    # Only the occupied states are needed
+    select = [(0, int(round(q[s]))) for s in range(H.spin_size)]
 
-    # Solve eigenvalue problems
-    def calc_occ(k, weight, spin):
-        n = np.empty_like(ni)
-        es = H.eigenstate(k, spin=spin)
-
-        n = einsum('ij,ij->j', conj(es.state[idx[spin]]), es.state[idx[spin]]).real * weight
-
-        # Calculate total energy
-        Etot = es.eig[idx[spin]].sum() * weight
-        # Return values
-        return n, Etot
+    # Solve eigenvalue problems for all k-points (stored in the eigen-cache), exactly once per call
+    with _timer(H, 'eigen'):
+        entries = _eigh_kpoints(H, executor, max_workers, select)
 
     # Loop k-points and weights
-    for w, k in zip(H.mp.weight, H.mp.k):
+    for ik, w in enumerate(H.mp.weight):
         for s in range(H.spin_size):
-            n, etot = calc_occ(k, w, s)
-            ni[s] += n
-            Etot += etot
+            eig, evec = entries[ik][s]
+
+            ni[s] += einsum('ji,ji->j', conj(evec), evec).real * w
 
+            # Calculate total energy
+            Etot += eig.sum() * w
+
+    return ni, (2./H.spin_size)*Etot
+
+
+def calc_n_batched(H, q):
+    r""" Obtain the spin densities for periodic or finite systems at a given temperature using stacked eigenvalue solvers
+
+    Drop-in replacement of `calc_n` for small and medium sized systems with many k-points.
+    The Bloch matrices of all k-points for each spin are assembled in a single ``(nk, no, no)`` array
+    which is diagonalized with one stacked ``eigh`` call. Occupations, densities and the total energy are
+    subsequently obtained with vectorized operations over the k-points. This avoids the Python overhead
+    per k-point at the expense of storing all eigenvectors at once (``nk * no**2`` complex numbers per spin).
+
+    The eigenstates are stored in the eigen-cache of `H` (see `hubbard.HubbardHamiltonian.set_eigen_cache`).
+
+    Parameters
+    ----------
+    H: HubbardHamiltonian
+        `hubbard.HubbardHamiltonian` object of the system to obtain the spin-densities from
+    q: array_like
+        charge resolved in spin channels (first index for up-electrons and second index for down-electrons)
+
+    See Also
+    ------------
+    calc_n: equivalent method diagonalizing one k-point at a time
+    """
+    k = H.mp.k
+    eig = np.empty((len(k), H.spin_size, H.sites))
+    norm2 = np.empty((H.spin_size, len(k), H.sites, H.sites))
+    revision = H._eig_revision()
+
+    # Real Bloch matrices are solved separately in real arithmetic
+    is_real = np.array([H._is_real(kk) for kk in k], dtype=bool)
+    for s in range(H.spin_size):
+        for idx in (is_real.nonzero()[0], (~is_real).nonzero()[0]):
+            if len(idx) == 0:
+                continue
+            with _timer(H, 'eigen'):
+                eig[idx, s], evec = _eigh_stack(H, k[idx], s)
+            for i, ik in enumerate(idx):
+                H._eig_cache.put(H._eig_key(k[ik], s, revision), eig[ik, s], evec[i])
+            if H.H.orthogonal:
+                norm2[s, idx] = (conj(evec) * evec).real
+            else:
+                norm2[s, idx] = (conj(evec) * (_Pk_stack(H, k[idx], H.H.S_idx) @ evec)).real
+            del evec
+
+    # Fermi level(s) and occupations
+    with _timer(H, 'fermi'):
+        Ef, occ = _fermi_dirac(eig, H.mp.weight, q, H.kT)
+    _record(H, Ef=Ef)
+    occ *= H.mp.weight.reshape(-1, 1, 1)
+
+    ni = np.empty((H.spin_size, H.sites))
+    Etot = 0
+    for s in range(H.spin_size):
+        ni[s] = einsum('kb,kib->i', occ[:, s], norm2[s])
+        Etot += (eig[:, s] * occ[:, s]).sum()
+
+    # Return spin densities and total energy
+    # if the Hamiltonian is not spin-polarized multiply Etot by 2 for spin degeneracy
     return ni, (2./H.spin_size)*Etot
@@ -0,0 +1,154 @@
+import functools
+import numpy as np
+from numpy import einsum, conj
+import sisl
+from hubbard.density import _Pk_stack, _fermi_dirac
+
+__all__ = ['converge_ensemble']
+
+
+def _onsite(H, spin):
+    """ Onsite energies (diagonal of the unit cell) of the spin Hamiltonian of `H` """
+    return H.H.tocsr(spin).diagonal()
+
+
+def _calc_n_ensemble(members, k, weight, T, S, Linv):
+    r""" Spin densities and band energies of all `members` from stacked eigenvalue problems
+
+    The Bloch matrices of member :math:`m` are :math:`T_k + \mathrm{diag}(E_m)`, where :math:`T_k` is common to all members
+
+    Parameters
+    ----------
+    members: list of HubbardHamiltonian
+        members to solve
+    k, weight: numpy.ndarray
+        common k-points and weights
+    T: numpy.ndarray
+        Bloch matrices without the onsite energies with shape ``(spin, nk, no, no)``
+    S: numpy.ndarray
+        overlap matrices with shape ``(nk, no, no)``, ``None`` for orthogonal basis sets
+    Linv: numpy.ndarray
+        inverse of the Cholesky factors of `S`
+
+    Returns
+    -------
+    list of tuple
+        ``(ni, Etot)`` of each member
+    """
+    nm, nk = len(members), len(k)
+    H0 = members[0]
+    no, spin_size = H0.sites, H0.spin_size
+    eig = np.empty((nm, nk, spin_size, no))
+    norm2 = np.empty((nm, spin_size, nk, no, no))
+    for s in range(spin_size):
+        E = np.array([_onsite(H, s) for H in members])
+        # (member, k, no, no) stack of Bloch matrices
+        Hk = np.broadcast_to(T[s], (nm,) + T[s].shape).copy()
+        Hk[..., range(no), range(no)] += E.reshape(nm, 1, no)
+        if Linv is None:
+            eig[:, :, s], evec = np.linalg.eigh(Hk)
+        else:
+            LinvH = conj(Linv.transpose(0, 2, 1))
+            eig[:, :, s], evec = np.linalg.eigh(Linv @ Hk @ LinvH)
+            evec = LinvH @ evec
+        if S is None:
+            norm2[:, s] = (conj(evec) * evec).real
+        else:
+            norm2[:, s] = (conj(evec) * (S @ evec)).real
+        del evec
+
+    out = []
+    for m, H in enumerate(members):
+        Ef, occ = _fermi_dirac(eig[m], weight, H.q, H.kT)
+        occ *= weight.reshape(-1, 1, 1)
+        ni = np.empty((spin_size, no))
+        Etot = 0
+        for s in range(spin_size):
+            ni[s] = einsum('kb,kib->i', occ[:, s], norm2[m, s])
+            Etot += (eig[m, :, s] * occ[:, s]).sum()
+        out.append((ni, (2./spin_size)*Etot))
+    return out
+
+
+def converge_ensemble(members, tol=1e-6, mixer=None, max_iter=None, print_info=False):
+    r""" Converge many `hubbard.HubbardHamiltonian` replicas of the same tight-binding model in a single batched cycle
+
+    The members may differ in their Coulomb parameters (``U``, ``Uij``), charges (``q``), temperatures (``kT``) and densities,
+    but must share the tight-binding Hamiltonian and the k-mesh. Since their Bloch matrices only differ on the diagonal,
+    the hopping part is assembled once and, at each iteration, the eigenvalue problems of all active members, k-points and spins
+    are solved with a single stacked ``eigh`` call per spin. This avoids the Python overhead and under-utilization of BLAS of
+    converging small systems one by one.
+
+    Each member is mixed with its own mixer through `hubbard.HubbardHamiltonian.iterate` (such that ``n``, ``Etot`` and the
+    telemetry are updated as in `hubbard.HubbardHamiltonian.converge`). Members drop out of the batch once
+    their density change is below `tol`. All eigenvectors of the batch are stored at once
+    (``nmembers * nk * no**2`` complex numbers per spin), so this is intended for small and medium sized systems.
+
+    Parameters
+    ----------
+    members: list of HubbardHamiltonian
+        the replicas to converge
+    tol: float, optional
+        tolerance criterion
+    mixer: callable, optional
+        factory of the mixer of each member, defaults to ``functools.partial(sisl.mixing.DIISMixer, 0.7, history=7)``
+    max_iter: int, optional
+        maximum number of iterations
+    print_info: bool, optional
+        print information about the convergence
+
+    Examples
+    --------
+    >>> members = [HubbardHamiltonian(Hsp2, U=u) for u in np.linspace(0, 4, 50)]
+    >>> dn = converge_ensemble(members, tol=1e-8)
+    >>> Etot = [H.Etot for H in members]
+
+    See Also
+    ------------
+    hubbard.calc_n_batched: equivalent batched method for a single `hubbard.HubbardHamiltonian`
+
+    Returns
+    -------
+    numpy.ndarray
+        final density change of each member
+    """
+    members = list(members)
+    if len(members) == 0:
+        return np.empty(0)
+    H0 = members[0]
+    k, weight = H0.mp.k, H0.mp.weight
+    for H in members[1:]:
+        if H._hash_base != H0._hash_base or H.spin_size != H0.spin_size:
+            raise ValueError('converge_ensemble requires members with the same tight-binding Hamiltonian')
+        if H.mp.k.shape != k.shape or not (np.allclose(H.mp.k, k) and np.allclose(H.mp.weight, weight)):
+            raise ValueError('converge_ensemble requires members with the same k-mesh')
+    if mixer is None:
+        mixer = functools.partial(sisl.mixing.DIISMixer, 0.7, history=7)
+    if max_iter is None:
+        max_iter = -1
+
+    # Hopping part of the Bloch matrices, common to all members
+    T = np.array([_Pk_stack(H0, k, s) for s in range(H0.spin_size)])
+    for s in range(H0.spin_size):
+        T[s][..., range(H0.sites), range(H0.sites)] -= _onsite(H0, s)
+    S, Linv = None, None
+    if not H0.H.orthogonal:
+        S = _Pk_stack(H0, k, H0.H.S_idx)
+        Linv = np.linalg.inv(np.linalg.cholesky(S))
+
+    mixers = [mixer() for _ in members]
+    dn = np.full(len(members), np.inf)
+    active = list(range(len(members)))
+    i = 0
+    if print_info:
+        print(f'   converge_ensemble: {len(members)} members towards tol={tol:.2e}')
+    while active and not 0 <= max_iter <= i:
+        i += 1
+        results = _calc_n_ensemble([members[m] for m in active], k, weight, T, S, Linv)
+        for m, (ni, Etot) in zip(active, results):
+            dn[m] = members[m].iterate(lambda H, q: (ni, Etot), mixer=mixers[m])
+        done = [m for m in active if dn[m] <= tol]
+        active = [m for m in active if dn[m] > tol]
+        if print_info and done:
+            print(f'   {len(done)} members converged in {i} iterations, {len(active)} active')
+    return dn
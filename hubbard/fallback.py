@@ -0,0 +1,169 @@
+from collections import deque
+import numpy as np
+import sisl
+from hubbard.telemetry import _record
+
+__all__ = ['MixerFallback']
+
+
+class MixerFallback(object):
+    """ Detection of oscillating or stagnating self-consistent cycles with automatic changes of the mixer
+
+    Instances are callbacks of `hubbard.HubbardHamiltonian.converge` (see also its `fallback` argument).
+    After each iteration the history of the densities, the density change and the total energy is checked for
+
+    - ``'cycle'``: the densities alternate between two configurations, i.e., the change with respect to the
+      previous-to-last iteration is smaller than the change with respect to the last iteration (ratio below `cycle_ratio`)
+      for `window` consecutive iterations. Also detected if the changes of the total energy alternate in sign over `window`
+      iterations without being damped (the last change is above `cycle_ratio` times the first one)
+    - ``'stagnation'``: the smallest density change of the last `window` iterations is not below
+      `stagnation_ratio` times the smallest one of the preceding iterations
+    - ``'rising'``: the total energy increases by more than `energy_tol` in each of the last `window` iterations
+
+    On detection, the next action of `policy` is applied (cycling through it):
+
+    - ``'weight'``: multiply the weight of the mixer by `factor` (skipped if this would go below `min_weight`)
+    - ``'reset'``: clear the history of the mixer
+    - ``'switch'``: replace a DIIS (Pulay) mixer by a linear mixer with the same weight, or any other mixer by a
+      DIIS mixer with `history` steps
+
+    After an action the detection restarts from an empty history. All actions are stored in `log`, printed
+    (if `verbose`) and added to the telemetry record of the iteration (if ``H.telemetry`` is set).
+    Once none of the actions can be applied anymore, this is logged only once.
+
+    Parameters
+    ----------
+    policy: list of str, optional
+        sequence of actions to apply
+    window: int, optional
+        number of iterations used to detect cycles and stagnation
+    cycle_ratio: float, optional
+        threshold of the ratio of density changes to detect a 2-cycle
+    stagnation_ratio: float, optional
+        required reduction of the density change over `window` iterations
+    energy_tol: float, optional
+        changes of the total energy below this value are not considered in the detection
+    factor: float, optional
+        factor by which the weight is reduced
+    min_weight: float, optional
+        smallest weight of the mixer
+    history: int, optional
+        history steps of the DIIS mixer created by ``'switch'``
+    verbose: bool, optional
+        print the actions
+
+    Attributes
+    ----------
+    log: list of dict
+        the applied actions with the ``iteration``, ``event``, ``action`` and the resulting ``mixer``
+
+    Examples
+    --------
+    >>> H.converge(calc_n, fallback=MixerFallback(policy=['weight', 'switch']))
+    """
+
+    def __init__(self, policy=('weight', 'reset', 'switch'), window=6, cycle_ratio=0.5, stagnation_ratio=0.9,
+                 factor=0.5, min_weight=0.01, history=7, verbose=False, energy_tol=1e-8):
+        for action in policy:
+            if action not in ('weight', 'reset', 'switch'):
+                raise ValueError(self.__class__.__name__ + f' does not implement action {action}')
+        if len(policy) == 0:
+            raise ValueError(self.__class__.__name__ + ' requires at least one action in policy')
+        self.policy = list(policy)
+        self.window = window
+        self.cycle_ratio = cycle_ratio
+        self.stagnation_ratio = stagnation_ratio
+        self.energy_tol = energy_tol
+        self.factor = factor
+        self.min_weight = min_weight
+        self.history = history
+        self.verbose = verbose
+        self.log = []
+        self._action = 0
+        self.reset()
+
+    def reset(self):
+        """ Restart the detection from an empty history """
+        # Only the values needed for the detection are kept
+        self._n = deque(maxlen=self.window + 2)
+        self._dn = deque(maxlen=self.window)
+        self._Etot = deque(maxlen=self.window + 1)
+        # Smallest density change of the iterations preceding the window
+        self._dn_min = np.inf
+
+    def detect(self):
+        """ Check the history for a 2-cycle, stagnation or a rising energy
+
+        Returns
+        -------
+        str or None
+            ``'cycle'``, ``'stagnation'``, ``'rising'`` or ``None``
+        """
+        n, w = self._n, self.window
+        if len(n) == w + 2:
+            # Change with respect to the last and the previous-to-last densities
+            d1 = [np.absolute(n[i] - n[i-1]).max() for i in range(2, w + 2)]
+            d2 = [np.absolute(n[i] - n[i-2]).max() for i in range(2, w + 2)]
+            if all(b < self.cycle_ratio * a for a, b in zip(d1, d2)):
+                return 'cycle'
+        if len(self._Etot) == w + 1:
+            dE = np.diff(self._Etot)
+            if np.all(np.absolute(dE) > self.energy_tol):
+                if np.all(dE[1:] * dE[:-1] < 0) and abs(dE[-1]) > self.cycle_ratio * abs(dE[0]):
+                    return 'cycle'
+                if np.all(dE > 0):
+                    return 'rising'
+        if len(self._dn) == w and min(self._dn) > self.stagnation_ratio * self._dn_min:
+            return 'stagnation'
+        return None
+
+    def _apply(self, action, mixer):
+        """ Apply `action` to `mixer`, returns the (new) mixer or ``None`` if the action cannot be applied """
+        if action == 'weight':
+            weight = getattr(mixer, 'weight', None)
+            if weight is None or weight * self.factor < self.min_weight:
+                return None
+            mixer.set_weight(weight * self.factor)
+            return mixer
+        if action == 'reset':
+            history = getattr(mixer, 'history', None)
+            if history is None or len(history) == 0:
+                return None
+            history.clear()
+            return mixer
+        weight = getattr(mixer, 'weight', 0.1)
+        if isinstance(mixer, sisl.mixing.DIISMixer):
+            return sisl.mixing.LinearMixer(weight)
+        return sisl.mixing.DIISMixer(weight, history=self.history)
+
+    def __call__(self, H, state):
+        self._n.append(state.n)
+        if len(self._dn) == self.window:
+            self._dn_min = min(self._dn_min, self._dn[0])
+        self._dn.append(state.dn)
+        self._Etot.append(state.Etot)
+        event = self.detect()
+        if event is None:
+            return False
+
+        # Try the actions of the policy in turn until one can be applied
+        for _ in range(len(self.policy)):
+            action = self.policy[self._action % len(self.policy)]
+            self._action += 1
+            mixer = self._apply(action, state.mixer)
+            if mixer is not None:
+                break
+        else:
+            action = None
+            mixer = state.mixer
+        self.reset()
+        if action is None and len(self.log) > 0 and self.log[-1]['action'] is None:
+            return False
+        state.mixer = mixer
+        entry = {'iteration': state.iteration, 'event': event, 'action': action,
+                 'mixer': {'name': mixer.__class__.__name__, 'weight': float(getattr(mixer, 'weight', np.nan))}}
+        self.log.append(entry)
+        _record(H, fallback=entry)
+        if self.verbose:
+            print(f"   {event} detected after {state.iteration} iterations, action: {action}, mixer: {entry['mixer']}")
+        return False
@@ -1,15 +1,314 @@
 import numpy as np
 import sisl
 import hubbard.ncsile as nc
+from hubbard.density import _fermi_level, _get_executor
+from hubbard.symmetry import symmetry_operations, reduce_kmesh
+from hubbard.telemetry import _timer
+from hubbard.fallback import MixerFallback
+from scipy.linalg import eigh as sp_eigh
 import hashlib
+import copy
+import functools
 import os
 import math
 import warnings
+import threading
+from collections import OrderedDict
 _pi = math.pi
+# Largest fraction of the spectrum for which the subset eigenvalue solvers are used
+_subset_ratio = 0.2
 
 __all__ = ['HubbardHamiltonian']
 
 
+def _digest(*arrays):
+    """ Digest of the content of `arrays`, used to detect modifications of the matrix elements """
+    h = hashlib.blake2b(digest_size=16)
+    for a in arrays:
+        h.update(np.ascontiguousarray(a))
+    return h.digest()
+
+
+class _EigenCache(object):
+    """ Least-recently-used cache of eigenvalues and eigenvectors with a memory cap
+
+    Entries are stored as ``(eig, evec, start)`` tuples, where ``evec`` may be ``None`` if only
+    eigenvalues were requested and ``start`` is the index of the first stored eigenpair
+    (only a subset of the spectrum may be stored). The cache is thread-safe and its content is not pickled
+    (so that `hubbard.HubbardHamiltonian` objects can be sent cheaply to process pools).
+
+    Parameters
+    ----------
+    max_memory: int, optional
+        maximum memory (in bytes) used for the stored arrays, 0 disables the cache
+    """
+
+    def __init__(self, max_memory=2**29):
+        self.max_memory = max_memory
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Remove all entries """
+        with self._lock:
+            self._data = OrderedDict()
+            self.memory = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, select, eigvals_only=True):
+        """ Return the ``(eig, evec)`` entry for `key` or ``None`` if it is not stored
+
+        Parameters
+        ----------
+        key: tuple
+            entry key
+        select: (int, int)
+            range ``[start, stop)`` of the requested eigenpairs, the entry is sliced accordingly
+        eigvals_only: bool, optional
+            whether the eigenvectors are required
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (not eigvals_only and entry[1] is None):
+                return None
+            eig, evec, start = entry
+            if select[0] < start or select[1] > start + len(eig):
+                return None
+            if select[0] > start or select[1] < start + len(eig):
+                i, j = select[0] - start, select[1] - start
+                eig = eig[i:j]
+                if evec is not None:
+                    evec = evec[:, i:j]
+            self._data.move_to_end(key)
+            return eig, evec
+
+    @staticmethod
+    def _nbytes(eig, evec):
+        return eig.nbytes + (0 if evec is None else evec.nbytes)
+
+    def put(self, key, eig, evec=None, start=0):
+        """ Store an entry, evicting the least recently used ones to fulfill the memory cap """
+        nbytes = self._nbytes(eig, evec)
+        if nbytes > self.max_memory:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.memory -= self._nbytes(*old[:2])
+            while self._data and self.memory + nbytes > self.max_memory:
+                _, (e, v, _) = self._data.popitem(last=False)
+                self.memory -= self._nbytes(e, v)
+            self._data[key] = (eig, evec, start)
+            self.memory += nbytes
+
+    def __getstate__(self):
+        return {'max_memory': self.max_memory}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_memory'])
+
+
+class _BlochCache(object):
+    """ Cache of dense Bloch matrices that are refreshed by only patching their diagonal
+
+    Between SCF iterations only the onsite elements of the Hamiltonian change, so a stored matrix
+    stays valid as long as the remaining matrix elements are unchanged (tracked by a revision number).
+    Entries are stored as ``(revision, onsite, Hk)`` tuples, where ``onsite`` are the onsite elements
+    already included in ``Hk``. New entries are only stored while the memory cap is not exceeded, since
+    the k-points are looped cyclically (a least-recently-used policy would then never reuse an entry).
+    The cache is thread-safe and its content is not pickled.
+
+    Parameters
+    ----------
+    max_memory: int, optional
+        maximum memory (in bytes) used for the stored arrays, 0 disables the cache
+    """
+
+    def __init__(self, max_memory=2**28):
+        self.max_memory = max_memory
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Remove all entries """
+        with self._lock:
+            self._data = {}
+            self.memory = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, revision, onsite):
+        """ Return the matrix stored for `key` with its diagonal updated to `onsite`, or ``None`` if not available """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] != revision:
+                return None
+            _, old, Hk = entry
+            diag = np.einsum('ii->i', Hk)
+            diag += onsite - old
+            self._data[key] = (revision, onsite, Hk)
+            return Hk
+
+    def put(self, key, revision, onsite, Hk):
+        """ Store an entry if it fits within the memory cap, entries with another revision are replaced """
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.memory -= old[2].nbytes
+            if self.memory + Hk.nbytes <= self.max_memory:
+                self._data[key] = (revision, onsite, Hk)
+                self.memory += Hk.nbytes
+
+    def __getstate__(self):
+        return {'max_memory': self.max_memory}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_memory'])
+
+
+class _AsyncWriter(object):
+    """ Perform file writes in a background thread
+
+    Each write is a callable (with the data already snapshotted) associated with a key, e.g., the file name.
+    A queued write that has not started yet is replaced by a newer one with the same key (only the latest state
+    of a file matters), and at most `maxsize` writes are queued, `submit` blocks otherwise.
+    `close` waits for all queued writes and raises the first error that occurred in the background thread.
+
+    Parameters
+    ----------
+    maxsize: int, optional
+        maximum number of queued writes
+    """
+
+    def __init__(self, maxsize=2):
+        self.maxsize = maxsize
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='hubbard-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                _, (func, args) = self._pending.popitem(last=False)
+                self._cond.notify_all()
+            try:
+                func(*args)
+            except BaseException as e:
+                if self._error is None:
+                    self._error = e
+
+    def submit(self, key, func, *args):
+        """ Queue ``func(*args)``, replacing a queued write with the same `key` """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('writer is closed')
+            while key not in self._pending and len(self._pending) >= self.maxsize:
+                self._cond.wait()
+            self._pending.pop(key, None)
+            self._pending[key] = (func, args)
+            self._cond.notify_all()
+
+    def close(self, raise_error=True):
+        """ Flush the queued writes and stop the background thread """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        if raise_error and self._error is not None:
+            raise self._error
+
+
+def _write_density(fn, mode, group, n, U, kT, units, Uij):
+    if not os.path.isfile(fn):
+        mode = 'w'
+    with nc.ncSileHubbard(fn, mode=mode) as fh:
+        fh.write_density(n, U, kT, units, Uij=Uij, group=group)
+
+
+def _write_checkpoint(fn, state):
+    tmp = str(fn) + '.tmp'
+    with nc.ncSileHubbard(tmp, mode='w') as fh:
+        fh.write_checkpoint(**state)
+    os.replace(tmp, fn)
+
+
+def _mixer_state(mixer):
+    """ History (as an array, or ``None`` if empty) and weight of `mixer`, which can be stored or pickled """
+    history = None
+    if mixer is not None and hasattr(mixer, 'history') and len(mixer.history) > 0:
+        history = np.array([[np.asarray(v, dtype=np.float64).ravel() for v in h] for h in mixer.history])
+    return history, getattr(mixer, 'weight', None)
+
+
+def _set_mixer_state(mixer, history, weight):
+    """ Restore the state returned by `_mixer_state` into `mixer` """
+    if mixer is None:
+        return
+    if weight is not None and hasattr(mixer, 'set_weight'):
+        mixer.set_weight(float(weight))
+    if history is not None and hasattr(mixer, 'history'):
+        mixer.history.clear()
+        for h in history:
+            mixer.history.append(*h)
+
+
+def _multistart_task(H, calc_n_method, mixer, n, mixer_state, iteration, steps, tol, max_iter, func_args):
+    """ Continue the self-consistent cycle of one start of `HubbardHamiltonian.multistart` for `steps` iterations
+
+    The mixer is created from the factory `mixer` and its state is passed explicitly, since mixers cannot be pickled
+    """
+    H.n = n
+    H.update_hamiltonian()
+    mixer = mixer()
+    _set_mixer_state(mixer, *mixer_state)
+    dn, converged = np.inf, False
+    for state in H.iter_converge(calc_n_method, tol, mixer, min(iteration + steps, max_iter), func_args, iteration=iteration):
+        iteration, dn, converged = state.iteration, state.dn, state.converged
+    return H.n, H.Etot, dn, _mixer_state(mixer), iteration, converged
+
+
+class SCFState(object):
+    """ State of a self-consistent cycle after an iteration, see `HubbardHamiltonian.iter_converge`
+
+    Attributes
+    ----------
+    iteration: int
+        number of completed iterations
+    dn: float
+        maximum density change of the iteration
+    Etot: float
+        total energy
+    n: numpy.ndarray
+        spin densities (not a copy, the array is not modified by the following iterations)
+    mixer: sisl.mixing.Mixer
+        mixer used in the iterations, it may be modified or replaced to change the mixing of the following iterations
+    converged: bool
+        whether the tolerance is reached
+    """
+    __slots__ = ('iteration', 'dn', 'Etot', 'n', 'mixer', 'converged')
+
+    def __init__(self, iteration, dn, Etot, n, mixer, converged):
+        self.iteration = iteration
+        self.dn = dn
+        self.Etot = Etot
+        self.n = n
+        self.mixer = mixer
+        self.converged = converged
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}{{iteration: {self.iteration}, dn: {self.dn}, Etot: {self.Etot}, converged: {self.converged}}}'
+
+
 class HubbardHamiltonian(object):
     """ A class to create a Self Consistent field (SCF) object related to the mean-field Hubbard (MFH) model
 
@@ -56,11 +355,21 @@ class HubbardHamiltonian(object):
         self.TBHam = TBHam
         self.H = TBHam.copy()
         self.H.finalize()
+        self._eig_cache = _EigenCache()
+        self._hk_cache = _BlochCache()
+        # Orbital colorings used by `hubbard.calc_n_kpm`, per (distance, sparsity pattern)
+        self._kpm_probing = {}
+        # Per-iteration records of the SCF cycle, see `hubbard.Telemetry`
+        self.telemetry = None
         self.geometry = TBHam.geometry
         # So far we only consider either unpolarized or spin-polarized Hamiltonians
         self.spin_size = self.H.spin.spinor
         self.sites = self.geometry.no
 
+        # Onsite energies of the TB Hamiltonian, the reference of the diagonal in `update_hamiltonian`
+        self._tb_onsite = np.array([TBHam.tocsr(spin).diagonal() for spin in range(self.spin_size)], dtype=self.H.dtype)
+        self._diag_idx = None
+
         # Use sum of all matrix elements as a basis for hash function calls
         H0 = self.TBHam.copy()
         H0.shift(np.pi) # Apply a shift to incorporate effect of S
@@ -134,30 +443,211 @@ class HubbardHamiltonian(object):
         """ The shape of the Hamiltonian matrix """
         return self.H.shape
 
-    def set_kmesh(self, nkpt=[1, 1, 1]):
+    def set_kmesh(self, nkpt=[1, 1, 1], symmetry=False):
         """ Set the k-mesh for the HubbardHamiltonian
 
         Parameters
         ----------
         nkpt : array_like or sisl.physics.BrillouinZone, optional
             k-mesh to be associated with the `hubbard.HubbardHamiltonian` instance
+        symmetry : bool, optional
+            reduce the Monkhorst-Pack grid (if `nkpt` is array_like) to its irreducible wedge by using time-reversal symmetry
+            and the spatial symmetry operations that leave the system invariant, i.e., the tight-binding
+            Hamiltonian, ``U`` *and* the current spin densities. The densities obtained in `iterate` are symmetrized accordingly,
+            so the SCF solution keeps the symmetry of the spin densities at the time this method is called.
+            Set the initial spin densities (e.g., `set_polarization`) before calling this method.
+            Note that site-resolved quantities obtained outside of `iterate` (e.g., `PDOS`) are not symmetrized
         """
+        self._sym_perm = None
         if isinstance(nkpt, sisl.BrillouinZone):
             self.mp = nkpt
         elif isinstance(nkpt, (np.ndarray, list)):
-            self.mp = sisl.MonkhorstPack(self.H, nkpt)
+            if symmetry:
+                # Time-reversal symmetry only holds for real Hamiltonians
+                trs = not np.iscomplexobj(self.H._csr._D)
+                mp = sisl.MonkhorstPack(self.H, nkpt, trs=False)
+                rotations, perms = symmetry_operations(self)
+                k, weight, used = reduce_kmesh(mp.k, mp.weight, rotations, trs=trs)
+                self.mp = sisl.BrillouinZone(self.H, k, weight)
+                self._sym_perm = perms[used]
+            else:
+                self.mp = sisl.MonkhorstPack(self.H, nkpt)
         else:
             raise ValueError(self.__class__.__name__ + '.set_kmesh(...) requires an array_like input')
 
+    def symmetrize(self, n):
+        """ Symmetrize the spin densities `n` with the symmetry operations used in the reduction of the k-mesh
+
+        Densities obtained by sampling only the irreducible k-points are symmetrized to those of the full k-mesh
+
+        Parameters
+        ----------
+        n: numpy.ndarray
+            spin densities with shape ``(spin, sites)``
+
+        See Also
+        ------------
+        set_kmesh
+        """
+        if self._sym_perm is None:
+            return n
+        return n[:, self._sym_perm].mean(1)
+
     def __str__(self):
         """ Representation of the model """
         s = self.__class__.__name__ + f'{{q: {self.q}, U: {self.U} {self.units}, kT: {self.kT} {self.units}, Uij: {self.Uij} {self.units}\n'
         s += str(self.H).replace('\n', '\n ')
         return s + '\n}'
 
+    def set_eigen_cache(self, max_memory):
+        """ Set the memory cap of the eigen-cache
+
+        The eigenvalues and eigenvectors obtained with `eigh` and `eigenstate` are stored per (k-point, spin, Hamiltonian)
+        such that subsequent calls (for instance the Fermi-level determination and the densities in `hubbard.calc_n`,
+        or post-processing routines like `DOS`, `PDOS` or `find_midgap`) do not diagonalize again.
+        The least recently used entries are discarded when the memory cap is reached.
+        The cache is emptied whenever the Hamiltonian is changed through `update_hamiltonian` or `shift`, and
+        entries are never reused if the matrix elements of ``self.H`` have been modified otherwise.
+
+        Parameters
+        ----------
+        max_memory: int
+            maximum memory in bytes, ``0`` disables the cache
+        """
+        self._eig_cache.max_memory = max_memory
+        self._eig_cache.clear()
+
+    def set_bloch_cache(self, max_memory):
+        """ Set the memory cap of the cache of dense Bloch matrices
+
+        The dense Hamiltonian matrices used in the diagonalizations and in `hubbard.NEGF` are stored per (k-point, spin).
+        Since only the diagonal of the Hamiltonian changes along the SCF cycle, a stored matrix is
+        refreshed by patching its diagonal instead of building it again from the sparse matrix.
+        When the memory cap is reached the remaining matrices are built on the fly.
+
+        Parameters
+        ----------
+        max_memory: int
+            maximum memory in bytes, ``0`` disables the cache
+        """
+        self._hk_cache.max_memory = max_memory
+        self._hk_cache.clear()
+
+    def _hk_revision(self):
+        """ Fingerprint of the matrix elements of ``self.H`` except for the (unit-cell) onsite Hamiltonian elements
+
+        Returns ``None`` if the onsite elements are not in the sparsity pattern
+        """
+        idx = self._diagonal_index()
+        if idx is None:
+            return None
+        csr = self.H._csr
+        D = csr._D.copy()
+        D[idx, :self.spin_size] = 0
+        return _digest(csr.ptr, csr.col, D)
+
+    def _Hk(self, k, spin, revision=None):
+        """ Dense Bloch Hamiltonian at `k` for `spin` retrieved (and stored) in the Bloch-matrix cache
+
+        The returned array is shared with the cache, it must not be modified and it is only valid until the next call
+        for the same k-point and spin
+        """
+        if revision is None:
+            revision = self._hk_revision()
+        cache = self._hk_cache
+        if revision is None or cache.max_memory <= 0:
+            if self.spin_size > 1:
+                return self.H.Hk(k=k, spin=spin, format='array')
+            return self.H.Hk(k=k, format='array')
+
+        key = (np.asarray(k, dtype=np.float64).tobytes(), spin)
+        onsite = self.H._csr._D[self._diag_idx, spin]
+        Hk = cache.get(key, revision, onsite)
+        if Hk is None:
+            if self.spin_size > 1:
+                Hk = self.H.Hk(k=k, spin=spin, format='array')
+            else:
+                Hk = self.H.Hk(k=k, format='array')
+            cache.put(key, revision, onsite, Hk)
+        return Hk
+
+    def _eig_revision(self):
+        """ Fingerprint of the current matrix elements used as part of the eigen-cache keys """
+        csr = self.H._csr
+        return _digest(csr.ptr, csr.col, csr._D)
+
+    def _eig_key(self, k, spin, revision):
+        return (np.asarray(k, dtype=np.float64).tobytes(), spin, revision)
+
+    def _eigh(self, k, spin, eigvals_only=True, revision=None, select=None):
+        """ Diagonalize at `k` for `spin` retrieving (and storing) the result in the eigen-cache
+
+        Parameters
+        ----------
+        select: (int, int), optional
+            only solve for the eigenpairs in the index range ``[start, stop)``
+        """
+        if revision is None:
+            revision = self._eig_revision()
+        if select is None:
+            select = (0, self.sites)
+        key = self._eig_key(k, spin, revision)
+        entry = self._eig_cache.get(key, select, eigvals_only)
+        if entry is None:
+            entry = self._eigh_solve(k, spin, eigvals_only, select)
+            if eigvals_only:
+                entry = (entry, None)
+            self._eig_cache.put(key, *entry, start=select[0])
+        return entry
+
+    def _is_real(self, k):
+        """ Whether the Bloch matrices at `k` are real, e.g., at the Gamma point or at zone-boundary
+        (time-reversal invariant) k-points of a real Hamiltonian """
+        if np.iscomplexobj(self.H._csr._D):
+            return False
+        phase = 2 * _pi * self.H.geometry.sc_off @ np.asarray(k, dtype=np.float64)
+        return np.allclose(np.sin(phase), 0, rtol=0, atol=1e-12)
+
+    def _eigh_solve(self, k, spin, eigvals_only=True, select=None):
+        """ Diagonalize at `k` for `spin` (bypassing the eigen-cache)
+
+        Real Bloch matrices are diagonalized with the real symmetric solver,
+        which returns real eigenvectors. If `select` is passed only the eigenpairs
+        in the index range ``[start, stop)`` are obtained
+        """
+        # The solvers overwrite the matrices, which must thus be copied from the cache
+        Hk = self._Hk(k, spin)
+        Sk = None if self.H.orthogonal else self.H.Sk(k=k, format='array')
+        if np.iscomplexobj(Hk) and self._is_real(k):
+            Hk = Hk.real.copy()
+            if Sk is not None:
+                Sk = Sk.real.copy()
+        else:
+            Hk = Hk.copy()
+        no = len(Hk)
+        if select is None or (select[0] <= 0 and select[1] >= no):
+            return sp_eigh(Hk, Sk, eigvals_only=eigvals_only, overwrite_a=True, overwrite_b=True)
+
+        start, stop = max(select[0], 0), min(select[1], no)
+        if stop <= start:
+            # Nothing to solve for
+            eig = np.empty(0)
+            return eig if eigvals_only else (eig, np.empty((no, 0), dtype=Hk.dtype))
+        if stop - start <= _subset_ratio * no:
+            return sp_eigh(Hk, Sk, eigvals_only=eigvals_only, overwrite_a=True, overwrite_b=True,
+                           subset_by_index=[start, stop - 1])
+        # For large subsets the divide-and-conquer solver for the full spectrum is faster than the
+        # subset solvers, only the selected part is retained (in particular in the eigen-cache)
+        if eigvals_only:
+            return sp_eigh(Hk, Sk, eigvals_only=True, overwrite_a=True, overwrite_b=True)[start:stop]
+        eig, evec = sp_eigh(Hk, Sk, overwrite_a=True, overwrite_b=True)
+        return eig[start:stop].copy(), evec[:, start:stop].copy()
+
     def eigh(self, k=[0, 0, 0], eigvals_only=True, spin=0):
         """ Diagonalize Hamiltonian using the ``eigh`` routine
 
+        The result is retrieved from the eigen-cache if available, see `set_eigen_cache`
+
         Parameters
         ----------
         k: array_like, optional
@@ -176,11 +666,16 @@ class HubbardHamiltonian(object):
         -------
         eigenvalues: numpy.ndarray
         """
-        return self.H.eigh(k=k, eigvals_only=eigvals_only, spin=spin)
+        eig, evec = self._eigh(k, spin, eigvals_only)
+        if eigvals_only:
+            return eig.copy()
+        return eig.copy(), evec.copy()
 
     def eigenstate(self, k, spin=0):
         """ Solve the eigenvalue problem at `k` and return it as a `sisl.physics.electron.EigenstateElectron` object containing all eigenstates
 
+        The result is retrieved from the eigen-cache if available, see `set_eigen_cache`
+
         Parameters
         ----------
         k: array_like
@@ -192,7 +687,9 @@ class HubbardHamiltonian(object):
         -------
         object: `sisl.physics.electron.EigenstateElectron` object
         """
-        return self.H.eigenstate(k, spin=spin)
+        eig, evec = self._eigh(k, spin, eigvals_only=False)
+        # Since eigh returns the eigenvectors [:, i] we have to transpose
+        return sisl.physics.electron.EigenstateElectron(evec.T.copy(), eig.copy(), self.H, k=k, gauge='R', spin=spin)
 
     def tile(self, reps, axis):
         """ Tile the HubbardHamiltonian object along a specified axis to obtain a larger one
@@ -322,10 +819,8 @@ class HubbardHamiltonian(object):
         + \langle n_{j\downarrow}\rangle\right)`
         will be added to the Hamiltonian in the `iterate` method, where the total energy is calculated
         """
-        E = np.empty((self.spin_size, self.sites), dtype=self.H.dtype)
-        for spin in range(self.spin_size):
-            # Extract diagonal elements of TB Hamiltonian
-            E[spin] = self.TBHam.tocsr(spin).diagonal()
+        # Start from the diagonal elements of TB Hamiltonian
+        E = self._tb_onsite.copy()
 
         ispin = np.arange(self.spin_size)[::-1]
         # diagonal elements
@@ -333,8 +828,38 @@ class HubbardHamiltonian(object):
         # off-diagonal elements
         if self.Uij is not None:
             E += self.Uij @ ((self.n[0]+self.n[-1]) - self.q0.sum() / (self.sites * 2)) # Same thing adds to both spin components
-        a = np.arange(len(self.H))
-        self.H[a, a, range(self.spin_size)] = E.T
+        idx = self._diagonal_index()
+        if idx is None:
+            # Some diagonal elements are not in the sparsity pattern, let sisl insert them
+            a = np.arange(len(self.H))
+            self.H[a, a, range(self.spin_size)] = E.T
+        else:
+            self.H._csr._D[idx, :self.spin_size] = E.T
+        self._eig_cache.clear()
+
+    def _diagonal_index(self):
+        """ Positions of the diagonal elements in the sparse data of ``self.H``
+
+        The positions are calculated once and reused as long as they remain valid for the sparsity pattern of ``self.H``.
+        Returns ``None`` if some of the diagonal elements are not in the sparsity pattern.
+        """
+        csr = self.H._csr
+        a = np.arange(self.sites)
+        idx = self._diag_idx
+        if idx is not None:
+            ptr = csr.ptr[:-1]
+            if (idx < ptr + csr.ncol).all() and (idx >= ptr).all() and (csr.col[idx] == a).all():
+                return idx
+        # Find the diagonal elements in the (possibly non-contiguous) sparse data
+        import sisl._array as _a
+        rows = np.repeat(a, csr.ncol)
+        pos = _a.array_arange(csr.ptr[:-1], n=csr.ncol)
+        diag = pos[csr.col[pos] == rows]
+        if len(diag) != self.sites:
+            self._diag_idx = None
+            return None
+        self._diag_idx = diag
+        return diag
 
     def random_density(self):
         """ Initialize spin polarization  with random density """
@@ -374,20 +899,29 @@ class HubbardHamiltonian(object):
         """ Find the midgap for the system
         taking into account the up and dn different spectrums
 
-        This method makes sense for insulators (where there is a bandgap)
+        This method makes sense for insulators (where there is a bandgap).
+        If all bands are empty (full) the lowest (highest) band edge is returned
 
         Returns
         -------
         midgap: float
         """
-        HOMO, LUMO = -1e10, 1e10
-        ev = np.zeros((self.spin_size, self.sites))
+        HOMO, LUMO = -np.inf, np.inf
+        revision = self._eig_revision()
         for k in self.mp.k:
+            # Only the HOMO and LUMO levels are needed
             for s in range(self.spin_size):
-                ev[s] = self.eigh(k=k, spin=s)
-            # If the Hamiltonian is not spin-polarized then ev is just repeated
-            HOMO = max(HOMO, ev[0, int(round(self.q[0] - 1))], ev[-1, int(round(self.q[-1] - 1))])
-            LUMO = min(LUMO, ev[0, int(round(self.q[0]))], ev[-1, int(round(self.q[-1]))])
+                iq = int(round(self.q[s]))
+                ev = self._eigh(k, s, revision=revision, select=(max(iq - 1, 0), min(iq + 1, self.sites)))[0]
+                # If the Hamiltonian is not spin-polarized then ev is just repeated
+                if iq > 0:
+                    HOMO = max(HOMO, ev[0])
+                if iq < self.sites:
+                    LUMO = min(LUMO, ev[-1])
+        if np.isinf(HOMO):
+            return LUMO
+        if np.isinf(LUMO):
+            return HOMO
         midgap = (HOMO + LUMO) * 0.5
         return midgap
 
@@ -419,8 +953,10 @@ class HubbardHamiltonian(object):
         if isinstance(distribution, str):
             distribution = sisl.get_distribution(distribution, smearing=self.kT)
 
-        Ef = self.H.fermi_level(self.mp, q=Q, distribution=distribution)
-        return Ef
+        # Eigenvalues are retrieved from the eigen-cache, if available
+        revision = self._eig_revision()
+        eig = np.array([[self._eigh(k, s, revision=revision)[0] for s in range(self.spin_size)] for k in self.mp.k])
+        return _fermi_level(eig, self.mp.weight, Q[:self.spin_size], distribution)
 
     def shift(self, E):
         """ Shift the electronic structure by a constant energy (in-place operation)
@@ -435,6 +971,7 @@ class HubbardHamiltonian(object):
         sisl.physics.Hamiltonian.shift
         """
         self.H.shift(E)
+        self._eig_cache.clear()
 
     def get_hash(self):
         return hashlib.md5((self.q.tostring()+np.array([self.U]).tostring()+np.array([self.kT]).tostring()+self._hash_base)).hexdigest()[:7]
@@ -475,10 +1012,83 @@ class HubbardHamiltonian(object):
         group: str, optional
             netCDF4 group
         """
-        if not os.path.isfile(fn):
-            mode = 'w'
-        fh = nc.ncSileHubbard(fn, mode=mode)
-        fh.write_density(self.n, self.U, self.kT, self.units, Uij=self.Uij, group=group)
+        _write_density(fn, mode, group, *self._density_state())
+
+    def _density_state(self):
+        # Snapshot of the data written by `write_density`
+        return self.n.copy(), self.U, self.kT, self.units, self.Uij
+
+    def write_checkpoint(self, fn, mixer=None, iteration=0, dn=np.inf):
+        """ Write the state of the self-consistent calculation in a binary file to restart it with `read_checkpoint`
+
+        The spin densities, total energy, number of completed iterations, k-mesh, hash (see `get_hash`) and,
+        if `mixer` is passed, the history and weight of the mixer are stored.
+        The file is first written to ``fn + '.tmp'`` which then replaces `fn`, so an existing checkpoint is never
+        corrupted if the calculation is killed while writing.
+
+        Parameters
+        ----------
+        fn: str
+            name of the checkpoint file
+        mixer: sisl.mixing.Mixer, optional
+            mixer used in the SCF cycle
+        iteration: int, optional
+            number of completed iterations
+        dn: float, optional
+            density change of the last iteration
+
+        See Also
+        ------------
+        converge
+        """
+        _write_checkpoint(fn, self._checkpoint_state(mixer, iteration, dn))
+
+    def _checkpoint_state(self, mixer=None, iteration=0, dn=np.inf):
+        # Snapshot of the data written by `write_checkpoint`
+        history, mixer_weight = _mixer_state(mixer)
+        return dict(n=self.n.copy(), iteration=iteration, Etot=getattr(self, 'Etot', 0.), dn=dn,
+                    k=self.mp.k.copy(), weight=self.mp.weight.copy(), hash=self.get_hash(),
+                    history=history, mixer_weight=mixer_weight)
+
+    def read_checkpoint(self, fn, mixer=None):
+        """ Restore the state of a self-consistent calculation written with `write_checkpoint`
+
+        The spin densities and total energy are restored and the Hamiltonian is updated.
+        If the k-mesh stored in the checkpoint differs from the current one, the stored one is used.
+        If `mixer` is passed its history and weight are restored.
+
+        Parameters
+        ----------
+        fn: str
+            name of the checkpoint file
+        mixer: sisl.mixing.Mixer, optional
+            mixer to be used in the continued SCF cycle
+
+        Returns
+        -------
+        iteration: int
+            number of completed iterations
+        dn: float
+            density change of the last iteration
+        """
+        with nc.ncSileHubbard(fn, mode='r') as fh:
+            state = fh.read_checkpoint()
+        if state['hash'] != self.get_hash():
+            raise ValueError(f'{self.__class__.__name__}.read_checkpoint: the checkpoint in {fn} belongs to another system '
+                             '(different charge, U, kT or tight-binding Hamiltonian)')
+        if state['n'].shape != self.n.shape:
+            raise ValueError(f'{self.__class__.__name__}.read_checkpoint: incorrect shape of n in {fn}')
+
+        if state['k'].shape != self.mp.k.shape or not (np.allclose(state['k'], self.mp.k) and np.allclose(state['wk'], self.mp.weight)):
+            warnings.warn(f'{self.__class__.__name__}.read_checkpoint: using the k-mesh stored in {fn}')
+            self.set_kmesh(sisl.BrillouinZone(self.H, state['k'], state['wk']))
+
+        self.n = state['n']
+        self.Etot = state['Etot']
+        self.update_hamiltonian()
+
+        _set_mixer_state(mixer, state['history'], state['mixer_weight'])
+        return state['iteration'], state['dn']
 
     def write_initspin(self, fn, ext_geom=None, spinfix=True, mode='a', eps=0.1):
         """ Write spin polarization to SIESTA fdf-block
@@ -559,7 +1169,14 @@ class HubbardHamiltonian(object):
                 if q[s] is None:
                     q[s] = int(round(self.q[s]))
 
-        ni, Etot = calc_n_method(self, q, **kwargs)
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.start()
+
+        with _timer(self, 'calc_n'):
+            ni, Etot = calc_n_method(self, q, **kwargs)
+        # Unfold the densities of an irreducible k-mesh
+        ni = self.symmetrize(ni)
 
         # Measure of density change
         ddm = ni - self.n
@@ -568,19 +1185,78 @@ class HubbardHamiltonian(object):
         # Update occupations on sites with mixing algorithm
         if mixer is None:
             mixer = sisl.mixing.LinearMixer(weight=0.7)
-        self.n = mixer(self.n.ravel(), ddm.ravel()).reshape(self.n.shape)
+        with _timer(self, 'mixing'):
+            self.n = mixer(self.n.ravel(), ddm.ravel()).reshape(self.n.shape)
 
         # Update spin hamiltonian
-        self.update_hamiltonian()
+        with _timer(self, 'update'):
+            self.update_hamiltonian()
 
         # Store total energy
         self.Etot = Etot - (self.U * ni[0]*ni[-1]).sum()
         # Inter-orbital term
         if self.Uij is not None:
             self.Etot -= 0.5*self.Uij @ (ni[0]+ni[-1]) @ (ni[0]+ni[-1])
+
+        if telemetry is not None:
+            stats = {'name': mixer.__class__.__name__}
+            if hasattr(mixer, 'weight'):
+                stats['weight'] = float(mixer.weight)
+            if hasattr(mixer, 'history'):
+                stats['history'] = len(mixer.history)
+            telemetry.finish(dn=float(dn), Etot=float(self.Etot), mixer=stats)
         return dn
 
-    def converge(self, calc_n_method, tol=1e-6, mixer=None, steps=100, max_iter=None, fn=None, print_info=False, func_args=dict()):
+    def iter_converge(self, calc_n_method, tol=1e-6, mixer=None, max_iter=None, func_args=dict(), iteration=0):
+        """ Generator version of `converge`, yielding the state of the self-consistent cycle after each iteration
+
+        The iterations stop when the tolerance or `max_iter` is reached, or at any time if the caller stops
+        consuming the generator (e.g., with ``break``). This allows custom stopping criteria, monitoring and changing the mixing
+        on the fly by modifying (or replacing) ``state.mixer``.
+
+        Parameters
+        ----------
+        calc_n_method: callable
+            method to obtain the spin-densities
+            it *must* return the corresponding spin-densities (``n``) and the total energy (``Etot``)
+        tol: float, optional
+            tolerance criterion
+        mixer: Mixer, optional
+            `sisl.mixing.Mixer` instance, defaults to ``sisl.mixing.DIISMixer(0.7, history=7)``
+        max_iter: int, optional
+            maximum number of iterations (including the already completed ones, see `iteration`)
+        func_args: dictionary, optional
+            function arguments to pass to calc_n_method
+        iteration: int, optional
+            number of already completed iterations
+
+        Examples
+        --------
+        >>> for state in H.iter_converge(calc_n, tol=1e-8):
+        ...     print(state.iteration, state.dn, state.Etot)
+        ...     if state.iteration == 50:
+        ...         state.mixer = sisl.mixing.LinearMixer(0.1)
+
+        Yields
+        ------
+        SCFState
+        """
+        if mixer is None:
+            mixer = sisl.mixing.DIISMixer(weight=0.7, history=7)
+        if max_iter is None:
+            max_iter = -1
+        i = iteration
+        while not 0 <= max_iter <= i:
+            i += 1
+            dn = self.iterate(calc_n_method, mixer=mixer, **func_args)
+            state = SCFState(i, dn, self.Etot, self.n, mixer, dn <= tol)
+            yield state
+            mixer = state.mixer
+            if state.converged:
+                return
+
+    def converge(self, calc_n_method, tol=1e-6, mixer=None, steps=100, max_iter=None, fn=None, print_info=False, func_args=dict(),
+                 checkpoint=None, resume=False, callbacks=(), fallback=None):
         """ Iterate Hamiltonian towards a specified tolerance criterion
 
         This method calls `iterate` as many times as it needs until it reaches the specified tolerance
@@ -602,13 +1278,31 @@ class HubbardHamiltonian(object):
             maximum number of iterations before stopping
         fn: str, optional
             optionally, one can save the spin-densities during the calculation (when the number of completed iterations reaches
-            the specified `steps`), by giving the name of the full name of the *binary file*
+            the specified `steps`), by giving the name of the full name of the *binary file*.
+            The files (`fn` and `checkpoint`) are written in a background thread, such that the SCF cycle does not wait for the I/O.
+            Only the latest state is written if the writes cannot keep up with the iterations,
+            and all writes are completed before this method returns (or raises)
         func_args: dictionary, optional
-            function arguments to pass to calc_n_method
+            function arguments to pass to calc_n_method, e.g., ``{'executor': 'thread'}`` to solve
+            the k-points in parallel with `hubbard.calc_n`
+        checkpoint: str, optional
+            name of a binary file where the full state of the SCF cycle (including the history of the `mixer`)
+            is written every `steps` iterations and at the end, see `write_checkpoint`
+        resume: bool, optional
+            restart from the state stored in `checkpoint` (if the file exists), see `read_checkpoint`.
+            The iterations are counted from the stored number of completed iterations
+        callbacks: list of callable, optional
+            functions called as ``callback(H, state)`` after each iteration, where ``state`` is a `SCFState`.
+            The cycle is stopped if any of them returns ``True``
+        fallback: hubbard.MixerFallback or bool, optional
+            detect oscillations and stagnation of the cycle and change the mixer accordingly.
+            If ``True`` a `hubbard.MixerFallback` with the default policy is used
 
         See Also
         ------------
         iterate
+        iter_converge
+        hubbard.MixerFallback
         hubbard.calc_n: method to obtain ``n`` and ``Etot`` for tight-binding Hamiltonians with finite or periodic boundary conditions at a certain `kT`
         hubbard.NEGF: class that contains the routines to obtain  ``n`` and ``Etot`` for tight-binding Hamiltonians with open boundary conditions
         sisl.mixing.AdaptiveDIISMixer: for adaptative DIIS (Pulay) mixing scheme
@@ -627,21 +1321,404 @@ class HubbardHamiltonian(object):
             max_iter = -1
         dn = 1.0
         i = 0
-        while dn > tol:
-            i += 1
-            dn = self.iterate(calc_n_method, mixer=mixer, **func_args)
-            if i % steps == 0:
-                # Print some info from time to time
+        if resume:
+            if checkpoint is None:
+                raise ValueError(self.__class__.__name__ + '.converge(...) requires a checkpoint file to resume from')
+            if os.path.isfile(checkpoint):
+                i, dn = self.read_checkpoint(checkpoint, mixer=mixer)
                 if print_info:
-                    print('   %i iterations completed:' % i, dn, self.Etot)
-                if fn:
-                    self.write_density(fn, 'a')
-            if i == max_iter:
-                return dn
+                    print('   resuming from %i completed iterations:' % i, dn, self.Etot)
+        if fallback is True:
+            fallback = MixerFallback(verbose=print_info)
+        if fallback:
+            # Run first, such that the other callbacks see the resulting mixer
+            callbacks = [fallback] + list(callbacks)
+        # The files are written in a background thread, which is flushed before returning
+        writer = _AsyncWriter() if fn or checkpoint else None
+        try:
+            converged = dn <= tol
+            if not converged:
+                for state in self.iter_converge(calc_n_method, tol, mixer, max_iter, func_args, iteration=i):
+                    i, dn, mixer, converged = state.iteration, state.dn, state.mixer, state.converged
+                    if i % steps == 0:
+                        # Print some info from time to time
+                        if print_info:
+                            print('   %i iterations completed:' % i, dn, self.Etot)
+                        with _timer(self, 'io'):
+                            if fn:
+                                writer.submit(fn, _write_density, fn, 'a', None, *self._density_state())
+                            if checkpoint:
+                                writer.submit(checkpoint, _write_checkpoint, checkpoint, self._checkpoint_state(mixer, i, dn))
+                    # All callbacks are called, even if one of them stops the cycle
+                    if any([bool(callback(self, state)) for callback in callbacks]):
+                        if print_info:
+                            print('   stopped by callback after %i iterations' % i)
+                        break
+                    # A callback may have replaced the mixer
+                    mixer = state.mixer
+            if converged and print_info:
+                print('   found solution in %i iterations' % i)
+            with _timer(self, 'io'):
+                if checkpoint:
+                    writer.submit(checkpoint, _write_checkpoint, checkpoint, self._checkpoint_state(mixer, i, dn))
+        except BaseException:
+            if writer is not None:
+                # Do not hide the original error by those of the writes
+                writer.close(raise_error=False)
+            if self.telemetry is not None:
+                self.telemetry.flush()
+            raise
+        try:
+            if writer is not None:
+                with _timer(self, 'io'):
+                    writer.close()
+        finally:
+            if self.telemetry is not None:
+                self.telemetry.flush()
+        return dn
+
+    def _residual(self, n, calc_n_method, func_args):
+        """ Residual ``calc_n_method(H(n)) - n`` of the mean-field equations, which leaves ``H`` in the state of `n` """
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.start()
+        self.n = n.reshape(self.n.shape).copy()
+        with _timer(self, 'update'):
+            self.update_hamiltonian()
+        with _timer(self, 'calc_n'):
+            ni, Etot = calc_n_method(self, self.q, **func_args)
+        ni = self.symmetrize(ni)
+        self.Etot = Etot - (self.U * ni[0]*ni[-1]).sum()
+        if self.Uij is not None:
+            self.Etot -= 0.5*self.Uij @ (ni[0]+ni[-1]) @ (ni[0]+ni[-1])
+        res = (ni - self.n).ravel()
+        if telemetry is not None:
+            telemetry.finish(dn=float(np.absolute(res).max()), Etot=float(self.Etot))
+        return res
+
+    def solve(self, calc_n_method, method='krylov', tol=1e-6, max_iter=None, print_info=False, func_args=dict(), options=None):
+        r""" Solve the mean-field equations as a non-linear system of equations, instead of the mixing of `converge`
+
+        The self-consistent densities are the root of the residual
+
+        .. math::
+            R(n) = \mathrm{calc\_n}(H[n]) - n
+
+        which is found with the (quasi-)Newton solvers of `scipy.optimize.root`:
+        Jacobian-free Newton-Krylov (``method='krylov'``), where the products of the Jacobian with vectors are approximated by
+        finite differences of the residual, or the (modified) Broyden and Anderson methods (``'broyden1'``, ``'broyden2'``,
+        ``'anderson'``). For strongly correlated systems, where the mixing converges slowly or oscillates, these need
+        significantly less evaluations of `calc_n_method`. Each evaluation of the residual is recorded by ``H.telemetry`` (if set).
+
+        Parameters
+        ----------
+        calc_n_method: callable
+            method to obtain the spin-densities
+            it *must* return the corresponding spin-densities (``n``) and the total energy (``Etot``)
+        method: {'krylov', 'broyden1', 'broyden2', 'anderson'}
+            non-linear solver
+        tol: float, optional
+            tolerance of the maximum absolute residual, the same criterion as the density change of `converge`
+        max_iter: int, optional
+            maximum number of (Newton) iterations of the solver, note that each iteration may evaluate the residual several times
+        print_info: bool, optional
+            print the result of the solver
+        func_args: dictionary, optional
+            function arguments to pass to calc_n_method
+        options: dict, optional
+            further options of the solver (e.g., ``{'jac_options': {'inner_maxiter': 10}}`` for ``'krylov'``),
+            see `scipy.optimize.show_options`
+
+        See Also
+        ------------
+        converge
+        scipy.optimize.root
+
+        Returns
+        -------
+        dn : float
+            maximum absolute residual of the final densities
+        """
+        from scipy.optimize import root
+        if method not in ('krylov', 'broyden1', 'broyden2', 'anderson'):
+            raise ValueError(self.__class__.__name__ + f'.solve(...) does not implement method={method}')
+        opts = {'fatol': tol, 'ftol': np.inf, 'xtol': np.inf, 'xatol': np.inf}
+        if max_iter is not None:
+            opts['maxiter'] = max_iter
+        if options is not None:
+            opts.update(options)
         if print_info:
-            print('   found solution in %i iterations' % i)
+            print(f'   HubbardHamiltonian: solve ({method}) towards tol={tol:.2e}')
+
+        res = root(self._residual, self.n.ravel(), args=(calc_n_method, func_args), method=method, options=opts)
+
+        # Make sure H corresponds to the solution
+        if not np.array_equal(res.x, self.n.ravel()):
+            dn = np.absolute(self._residual(res.x, calc_n_method, func_args)).max()
+        else:
+            dn = np.absolute(res.fun).max()
+        if print_info:
+            print(f'   {res.message} ({res.nit} iterations):', dn, self.Etot)
         return dn
 
+    def sweep(self, calc_n_method, path, tol=1e-6, mixer=None, extrapolate=1, keep_history=0., fn=None, group=None,
+              print_info=False, **kwargs):
+        r""" Converge the system along a path of parameters (``U``, ``kT`` and/or ``q``) using the previous solutions as starting points
+
+        For each point of the path the parameters are set and `converge` is called. The initial densities are
+        extrapolated with a polynomial of order `extrapolate` through the solutions of the previous points,
+        as a function of the (Euclidean) length :math:`s` along the path of parameters
+
+        .. math::
+            n_0(s_i) = \sum_{j=1}^{p+1} n(s_{i-j}) \prod_{l\neq j} \frac{s_i - s_{i-l}}{s_{i-j} - s_{i-l}}
+
+        and re-normalized to the charge. This is usually much closer to the solution than the previous densities
+        for smooth parts of the path. The history of the mixer is kept between points if the relative change of the parameters is
+        not above `keep_history`, and cleared otherwise. By default it is only kept for repeated parameters, since the residuals of
+        other parameters in the history generally slow down the convergence.
+
+        Parameters
+        ----------
+        calc_n_method: callable
+            method to obtain the spin-densities
+            it *must* return the corresponding spin-densities (``n``) and the total energy (``Etot``)
+        path: dict
+            values of the parameters at each point of the path, e.g., ``{'U': np.linspace(0, 4, 21)}``.
+            The keys must be ``'U'``, ``'kT'`` or ``'q'``, and all values must have the same length
+        tol: float, optional
+            tolerance criterion of each point
+        mixer: Mixer, optional
+            `sisl.mixing.Mixer` instance used for all points, defaults to ``sisl.mixing.DIISMixer(0.7, history=7)``
+        extrapolate: int, optional
+            order of the extrapolation of the initial densities (0 starts from the solution of the previous point)
+        keep_history: float, optional
+            largest relative change of the parameters for which the history of the mixer is kept
+        fn: str, optional
+            file in which the densities of all points are stored, each in its own group
+        group: callable, optional
+            name of the group of each point, called with a dictionary of the parameters.
+            Defaults to names like ``'U=3.5,kT=0.025'``
+        print_info: bool, optional
+            print information about each point
+        **kwargs:
+            further arguments passed to `converge`
+
+        Examples
+        --------
+        >>> points = H.sweep(calc_n, {'U': np.linspace(0, 4, 41)}, fn='sweep.nc')
+        >>> Etot = [p['Etot'] for p in points]
+        >>> H.read_density('sweep.nc', group='U=2')
+
+        See Also
+        ------------
+        converge
+
+        Returns
+        -------
+        list of dict
+            for each point, the parameters (under their names), the densities ``n``, the total energy ``Etot``
+            and the final density change ``dn``
+        """
+        names = list(path.keys())
+        for name in names:
+            if name not in ('U', 'kT', 'q'):
+                raise ValueError(self.__class__.__name__ + f'.sweep(...) cannot sweep the parameter {name}')
+        values = [list(path[name]) for name in names]
+        npoints = len(values[0])
+        if any(len(v) != npoints for v in values):
+            raise ValueError(self.__class__.__name__ + '.sweep(...) requires the same number of values for all parameters')
+        if mixer is None:
+            mixer = sisl.mixing.DIISMixer(weight=0.7, history=7)
+        if group is None:
+            def group(params):
+                return ','.join(name + '=' + ','.join(f'{x:g}' for x in np.ravel(v)) for name, v in params.items())
+
+        points = []
+        # Path length and solutions of the previous points for the extrapolation
+        s, ns = [], []
+        p_prev = None
+        writer = _AsyncWriter() if fn else None
+        try:
+            for i in range(npoints):
+                params = {name: v[i] for name, v in zip(names, values)}
+                p = np.concatenate([np.ravel(v) for v in params.values()]).astype(np.float64)
+                for name, v in params.items():
+                    if name == 'q':
+                        self.q = np.array(v, dtype=np.float64).ravel()[:self.spin_size]
+                    else:
+                        setattr(self, name, v)
+
+                if p_prev is not None:
+                    dp = np.linalg.norm(p - p_prev)
+                    s.append(s[-1] + dp)
+                    order = min(extrapolate, len(ns) - 1)
+                    if order > 0:
+                        # Lagrange polynomial through the last order+1 points
+                        sj = s[-order-2:-1]
+                        n0 = 0.
+                        for j in range(order + 1):
+                            c = np.prod([(s[-1] - sj[l]) / (sj[j] - sj[l]) for l in range(order + 1) if l != j])
+                            n0 = n0 + c * ns[-order-1+j]
+                        self.n = np.clip(n0, 0, 1)
+                    else:
+                        self.n = ns[-1].copy()
+                    self.normalize_charge()
+                    if dp > keep_history * np.linalg.norm(p_prev):
+                        if hasattr(mixer, 'history'):
+                            mixer.history.clear()
+                else:
+                    s.append(0.)
+                self.update_hamiltonian()
+
+                if print_info:
+                    print(f'   HubbardHamiltonian: sweep point {i+1}/{npoints}', params)
+                dn = self.converge(calc_n_method, tol=tol, mixer=mixer, print_info=print_info, **kwargs)
+                ns.append(self.n.copy())
+                p_prev = p
+                points.append({**params, 'n': self.n.copy(), 'Etot': self.Etot, 'dn': dn})
+                if fn:
+                    with _timer(self, 'io'):
+                        writer.submit((fn, group(params)), _write_density, fn, 'a', group(params), *self._density_state())
+        except BaseException:
+            if writer is not None:
+                writer.close(raise_error=False)
+            raise
+        if writer is not None:
+            writer.close()
+        return points
+
+    def multistart(self, calc_n_method, starts=8, seed=None, tol=1e-6, max_iter=500, steps=20, mixer=None,
+                   prune=0.1, prune_dn=1e-3, similarity=1e-3, executor=None, max_workers=None, func_args=dict()):
+        """ Search the ground state by converging the system from several initial densities
+
+        The starts are iterated in rounds of `steps` iterations, which can be distributed over the workers of an executor.
+        After each round, unconverged starts whose density change is below `prune_dn` (such that their energy is reliable)
+        and whose energy is more than `prune` above the lowest energy of the converged starts are discarded.
+        Converged solutions whose densities differ less than `similarity` (also after exchanging the spin channels, if
+        both have the same charge) are merged.
+
+        Starts that do not converge within `max_iter` iterations are reported with a warning.
+        After the search ``H`` is left in the lowest-energy solution.
+
+        Parameters
+        ----------
+        calc_n_method: callable
+            method to obtain the spin-densities
+            it *must* return the corresponding spin-densities (``n``) and the total energy (``Etot``)
+        starts: int or list, optional
+            number of random initial densities, or a list of initial densities (arrays with the shape of ``H.n``,
+            or ``None`` for a random density), e.g., obtained with `set_polarization` or `polarize_sublattices`
+        seed: int, optional
+            seed of the random initial densities, each start uses an independent stream such that the results
+            do not depend on the executor
+        tol: float, optional
+            tolerance criterion
+        max_iter: int, optional
+            maximum number of iterations of each start
+        steps: int, optional
+            number of iterations of each round
+        mixer: callable, optional
+            factory of the mixer of each start, defaults to ``functools.partial(sisl.mixing.DIISMixer, 0.7, history=7)``.
+            It must be picklable to use processes
+        prune: float, optional
+            energy margin above the best solution to prune starts, ``None`` to disable pruning
+        prune_dn: float, optional
+            density change below which starts are pruned
+        similarity: float, optional
+            largest absolute difference between the densities of equivalent solutions
+        executor: None, str or concurrent.futures.Executor, optional
+            ``'thread'`` or ``'process'`` to create a pool, or an existing executor. ``calc_n_method`` must be picklable to use processes
+        max_workers: int, optional
+            number of workers for the pool created here
+        func_args: dictionary, optional
+            function arguments to pass to calc_n_method
+
+        Examples
+        --------
+        >>> H.set_polarization([6], dn=[28])
+        >>> solutions = H.multistart(calc_n_insulator, starts=[H.n.copy()] + [None] * 15, seed=42)
+        >>> [s['Etot'] for s in solutions]
+
+        Returns
+        -------
+        list of dict
+            distinct converged solutions sorted by energy, with the densities ``n``, the total energy ``Etot``, the density change ``dn``
+            and the indices of the ``starts`` that converged to it
+        """
+        if mixer is None:
+            mixer = functools.partial(sisl.mixing.DIISMixer, 0.7, history=7)
+        if isinstance(starts, int):
+            starts = [None] * starts
+        seeds = np.random.SeedSequence(seed).spawn(len(starts))
+        ns = []
+        for n, ss in zip(starts, seeds):
+            if n is None:
+                n = np.random.default_rng(ss).random((self.spin_size, self.sites))
+                n *= (self.q / n.sum(1)).reshape(-1, 1)
+            else:
+                n = np.array(n, dtype=np.float64).reshape(self.n.shape)
+            ns.append(n)
+
+        # One replica per start, since the starts may be iterated concurrently in threads
+        telemetry, self.telemetry = self.telemetry, None
+        try:
+            replicas = [copy.deepcopy(self) for _ in ns]
+        finally:
+            self.telemetry = telemetry
+        active = {i: (ns[i], (None, None), 0) for i in range(len(ns))}
+        converged = []
+        failed = []
+        best = np.inf
+
+        pool, shutdown = _get_executor(executor, max_workers)
+        try:
+            while active:
+                args = [(replicas[i], calc_n_method, mixer, n, mixer_state, it, steps, tol, max_iter, func_args)
+                        for i, (n, mixer_state, it) in active.items()]
+                if pool is None:
+                    results = [_multistart_task(*a) for a in args]
+                else:
+                    results = [f.result() for f in [pool.submit(_multistart_task, *a) for a in args]]
+                round_ = {}
+                for i, (n, Etot, dn, mixer_state, it, conv) in zip(list(active), results):
+                    if conv:
+                        converged.append((i, n, Etot, dn))
+                        best = min(best, Etot)
+                    elif it < max_iter:
+                        round_[i] = (n, mixer_state, it, Etot, dn)
+                    else:
+                        failed.append(i)
+                active = {}
+                for i, (n, mixer_state, it, Etot, dn) in round_.items():
+                    if prune is not None and dn < prune_dn and Etot > best + prune:
+                        continue
+                    active[i] = (n, mixer_state, it)
+        finally:
+            if shutdown:
+                pool.shutdown()
+
+        if failed:
+            warnings.warn(f'{self.__class__.__name__}.multistart: starts {sorted(failed)} did not converge in {max_iter} iterations')
+
+        # Merge equivalent solutions, starting from the lowest energy
+        solutions = []
+        for i, n, Etot, dn in sorted(converged, key=lambda c: c[2]):
+            for sol in solutions:
+                if np.absolute(n - sol['n']).max() < similarity or \
+                   (self.spin_size == 2 and np.isclose(self.q[0], self.q[1]) and np.absolute(n[::-1] - sol['n']).max() < similarity):
+                    sol['starts'].append(i)
+                    break
+            else:
+                solutions.append({'n': n, 'Etot': Etot, 'dn': dn, 'starts': [i]})
+
+        for sol in solutions:
+            sol['starts'].sort()
+        if len(solutions) > 0:
+            self.n = solutions[0]['n'].copy()
+            self.update_hamiltonian()
+            self.Etot = solutions[0]['Etot']
+        return solutions
+
     def calc_orbital_charge_overlaps(self, k=[0, 0, 0], spin=0):
         r""" Obtain orbital (eigenstate) charge overlaps as :math:`\int dr |\psi_{\sigma\alpha}|^{4}`
 
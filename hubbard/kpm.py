@@ -0,0 +1,217 @@
+import numpy as np
+from numpy import conj
+import scipy.sparse as sp
+import math
+from hubbard.hamiltonian import _digest
+
+_pi = math.pi
+
+__all__ = ['calc_n_kpm']
+
+
+def _spectral_bounds(Hk, eps=0.01):
+    """ Gershgorin estimate of the spectral bounds of `Hk`, widened by a fraction `eps` """
+    diag = Hk.diagonal().real
+    radius = np.asarray(abs(Hk).sum(axis=1)).ravel() - np.abs(diag)
+    emin, emax = (diag - radius).min(), (diag + radius).max()
+    de = max(emax - emin, 1e-8) * eps
+    return emin - de, emax + de
+
+
+def _jackson(order):
+    """ Jackson kernel damping factors to suppress Gibbs oscillations """
+    m = np.arange(order)
+    N = order + 1
+    return ((N - m) * np.cos(_pi * m / N) + np.sin(_pi * m / N) / np.tan(_pi / N)) / N
+
+
+def _chebyshev_quadrature(order):
+    r""" Chebyshev-Gauss quadrature to project functions on :math:`[-1, 1]` onto the first `order` Chebyshev polynomials
+
+    Returns
+    -------
+    x: numpy.ndarray
+        quadrature points
+    C: numpy.ndarray
+        matrix such that ``C @ f(x)`` are the Chebyshev expansion coefficients of ``f``
+    """
+    npts = 2 * order
+    theta = _pi * (np.arange(npts) + 0.5) / npts
+    C = np.cos(np.outer(np.arange(order), theta)) * (2. / npts)
+    C[0] *= 0.5
+    return np.cos(theta), C
+
+
+def _probing_colors(H, distance):
+    """ Greedy coloring of the orbitals such that orbitals with the same color are more than `distance` hoppings apart
+
+    The colorings are stored in `H` since the sparsity pattern does not change along the SCF cycle.
+    They are keyed on a digest of the sparsity pattern, such that a coloring is never reused for another pattern
+    """
+    csr = H.H._csr
+    key = (distance, _digest(csr.ptr, csr.ncol, csr.col))
+    probing = H._kpm_probing
+    if key not in probing:
+        # Colorings of previous sparsity patterns are not needed anymore
+        for old in [old for old in probing if old[1] != key[1]]:
+            del probing[old]
+        A = H.H.tocsr(0)
+        no = H.sites
+        # Fold the supercell connections into the unit cell
+        A = sp.csr_matrix((np.ones(A.nnz, dtype=np.int8), A.indices % no, A.indptr), shape=(no, no))
+        A = ((A + A.T + sp.identity(no, dtype=np.int8, format='csr')) != 0).astype(np.int8)
+        reach = A.copy()
+        for _ in range(distance - 1):
+            reach = ((reach @ A) != 0).astype(np.int8)
+        reach = reach.tocsr()
+        colors = np.full(no, -1, dtype=np.int64)
+        for i in range(no):
+            used = colors[reach.indices[reach.indptr[i]:reach.indptr[i+1]]]
+            c = 0
+            used = set(used[used >= 0].tolist())
+            while c in used:
+                c += 1
+            colors[i] = c
+        probing[key] = colors
+    return probing[key]
+
+
+def _moments(Hk, emin, emax, order, V):
+    r""" Diagonal Chebyshev moments :math:`\mathrm{Re}[v_i^* (T_m(\tilde H) v)_i]` summed over the columns of `V`
+
+    Returns
+    -------
+    numpy.ndarray
+        moments with shape ``(order, no)``
+    """
+    a = (emax - emin) * 0.5
+    b = (emax + emin) * 0.5
+    Ht = (Hk - b * sp.identity(Hk.shape[0], dtype=Hk.dtype, format='csr')) * (1. / a)
+    mu = np.empty((order, Hk.shape[0]))
+    T0 = V.astype(np.result_type(Hk.dtype, V.dtype))
+    T1 = Ht @ T0
+    mu[0] = (conj(V) * T0).real.sum(1)
+    if order > 1:
+        mu[1] = (conj(V) * T1).real.sum(1)
+    for m in range(2, order):
+        T0, T1 = T1, 2 * (Ht @ T1) - T0
+        mu[m] = (conj(V) * T1).real.sum(1)
+    return mu
+
+
+def calc_n_kpm(H, q, order=400, distance=6, nrandom=None, seed=None, q_tol=1e-10):
+    r""" Method to obtain the spin densities from a Chebyshev (kernel polynomial) expansion of the Fermi operator
+
+    Instead of diagonalizing the Hamiltonian, the diagonal of the density matrix
+
+    .. math::
+        \langle n_{i\sigma} \rangle = \sum_k w_k [f_{\mu_\sigma}(H_{k\sigma})]_{ii}
+
+    is obtained from the Chebyshev moments of the sparse Hamiltonian rescaled into :math:`[-1, 1]`,
+    with :math:`f_\mu` the Fermi-Dirac distribution at temperature ``H.kT``.
+    The moments are calculated once per k-point and spin, so the chemical potential (:math:`\mu_\sigma`)
+    is found by bisection on the charge without any further matrix-vector products.
+    This makes the cost linear in the number of orbitals, which is suited for very large systems.
+    The stored moments require ``order * no`` floats per spin.
+
+    The diagonal elements are estimated by acting with the Chebyshev polynomials on a set of vectors:
+    either probing vectors (one per color of a distance-`distance` coloring of the orbital graph, which is exact up to
+    the contributions of orbitals further apart than `distance` hoppings) or `nrandom` random phase vectors (stochastic
+    estimation, with an error decreasing as the square root of `nrandom`).
+
+    The expansion uses the Jackson kernel. Its energy resolution (:math:`\sim\pi\Delta E/\mathrm{order}`, with :math:`\Delta E` the
+    spectral width) sets the effective smearing when it is larger than ``H.kT``.
+
+    Parameters
+    ----------
+    H: HubbardHamiltonian
+        `hubbard.HubbardHamiltonian` object of the system to obtain the spin-densities from
+    q: array_like
+        charge resolved in spin channels (first index for up-electrons and second index for down-electrons)
+    order: int, optional
+        number of Chebyshev moments
+    distance: int, optional
+        graph distance used for the probing vectors
+    nrandom: int, optional
+        if passed, use this number of random vectors instead of the probing vectors
+    seed: int, optional
+        seed for the random vectors
+    q_tol: float, optional
+        tolerance of the charge in the chemical potential bisection
+
+    Notes
+    -----
+    Only orthogonal basis sets are implemented
+
+    See Also
+    ------------
+    calc_n: method based on the direct diagonalization of the Hamiltonian
+    """
+    if not H.H.orthogonal:
+        raise ValueError('calc_n_kpm is only implemented for orthogonal basis sets')
+
+    no = H.sites
+    if nrandom is None:
+        colors = _probing_colors(H, distance)
+        V = np.zeros((no, colors.max() + 1))
+        V[np.arange(no), colors] = 1.
+    else:
+        rng = np.random.default_rng(seed)
+        V = np.exp(2j * _pi * rng.random((no, nrandom))) / np.sqrt(nrandom)
+
+    def Hk(k, spin):
+        if H.spin_size > 1:
+            return H.H.Hk(k=k, spin=spin, format='csr')
+        return H.H.Hk(k=k, format='csr')
+
+    # A common energy window for all k-points and spins to define the expansions of the Fermi function
+    bounds = np.array([_spectral_bounds(Hk(k, s)) for s in range(H.spin_size) for k in H.mp.k])
+    emin, emax = bounds[:, 0].min(), bounds[:, 1].max()
+    a, b = (emax - emin) * 0.5, (emax + emin) * 0.5
+
+    # Diagonal moments per spin and orbital, integrated over k-points
+    mu_k = np.zeros((H.spin_size, order, no))
+    for s in range(H.spin_size):
+        for w, k in zip(H.mp.weight, H.mp.k):
+            mu_k[s] += w * _moments(Hk(k, s), emin, emax, order, V)
+    tot = mu_k.sum(-1)
+    g = _jackson(order)
+
+    # Energies at the quadrature points and the spectral density projected on them, such that
+    # the charge for a given chemical potential is a simple dot-product
+    x, C = _chebyshev_quadrature(order)
+    E = a * x + b
+    dos = (C.T @ (g.reshape(-1, 1) * tot.T)).T
+    kT = max(H.kT, 1e-12)
+
+    def fermi(mu_c):
+        return 0.5 * (1 - np.tanh((E - mu_c) / (2 * kT)))
+
+    def find_mu(qs, dos):
+        lo, hi = emin, emax
+        while True:
+            mid = 0.5 * (lo + hi)
+            qt = fermi(mid) @ dos
+            if abs(qt - qs) < q_tol or np.nextafter(lo, hi) >= hi:
+                return mid
+            if qt > qs:
+                hi = mid
+            else:
+                lo = mid
+
+    q = np.asarray(q, dtype=np.float64).ravel()
+    if H.spin_size == 2 and q.size == 2:
+        Ef = [find_mu(q[s], dos[s]) for s in range(2)]
+    else:
+        Ef = [find_mu(q.sum(), dos.sum(0))] * H.spin_size
+
+    ni = np.empty((H.spin_size, no))
+    Etot = 0.
+    for s in range(H.spin_size):
+        f = fermi(Ef[s])
+        ni[s] = (g * (C @ f)) @ mu_k[s]
+        Etot += (E * f) @ dos[s]
+
+    # Return spin densities and total energy
+    # if the Hamiltonian is not spin-polarized multiply Etot by 2 for spin degeneracy
+    return ni, (2./H.spin_size)*Etot
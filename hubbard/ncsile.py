@@ -173,4 +173,106 @@ class ncSileHubbard(sisl.SileCDF):
             v4.info = 'Off diagonal Coulomb repulsion elements in' + units
             v4[:] = Uij
 
+    def write_checkpoint(self, n, iteration, Etot, dn, k, weight, hash, history=None, mixer_weight=None, group=None):
+        """ Write the state of a self-consistent calculation to restart it
+
+        Parameters
+        ----------
+        n: numpy.ndarray
+            spin densities
+        iteration: int
+            number of completed iterations
+        Etot: float
+            total energy
+        dn: float
+            density change of the last iteration
+        k: numpy.ndarray
+            k-points of the Brillouin zone sampling
+        weight: numpy.ndarray
+            weights of the k-points
+        hash: str
+            hash of the `hubbard.HubbardHamiltonian` object (see `hubbard.HubbardHamiltonian.get_hash`)
+        history: numpy.ndarray, optional
+            history of the mixer with shape ``(nhist, nvar, nspin * norb)``
+        mixer_weight: float, optional
+            current weight of the mixer
+        group: str, optional
+           netcdf group
+        """
+        # Create group
+        if group is not None:
+            g = self._crt_grp(self, group)
+        else:
+            g = self
+
+        self._crt_dim(g, 'nspin', n.shape[0])
+        self._crt_dim(g, 'norb', n.shape[1])
+        self._crt_dim(g, 'nk', len(k))
+        self._crt_dim(g, 'xyz', 3)
+
+        g.setncattr('hash', hash)
+        v = self._crt_var(g, 'n', 'f8', ('nspin', 'norb'))
+        v.info = 'Spin densities'
+        v[:] = n
+        v = self._crt_var(g, 'iteration', 'i4')
+        v.info = 'Number of completed iterations'
+        v[:] = iteration
+        v = self._crt_var(g, 'Etot', 'f8')
+        v.info = 'Total energy'
+        v[:] = Etot
+        v = self._crt_var(g, 'dn', 'f8')
+        v.info = 'Density change of the last iteration'
+        v[:] = dn
+        v = self._crt_var(g, 'k', 'f8', ('nk', 'xyz'))
+        v.info = 'k-points in reduced coordinates'
+        v[:] = k
+        v = self._crt_var(g, 'wk', 'f8', ('nk',))
+        v.info = 'k-point weights'
+        v[:] = weight
+
+        if mixer_weight is not None:
+            v = self._crt_var(g, 'mixer_weight', 'f8')
+            v.info = 'Weight of the mixer'
+            v[:] = mixer_weight
+
+        if history is not None and len(history) > 0:
+            self._crt_dim(g, 'nhist', history.shape[0])
+            self._crt_dim(g, 'nvar', history.shape[1])
+            self._crt_dim(g, 'nmix', history.shape[2])
+            v = self._crt_var(g, 'history', 'f8', ('nhist', 'nvar', 'nmix'))
+            v.info = 'History of the mixer'
+            v[:] = history
+
+    def read_checkpoint(self, group=None):
+        """ Read the state of a self-consistent calculation written with `write_checkpoint`
+
+        Parameters
+        ----------
+        group: str, optional
+           netcdf group
+
+        Returns
+        -------
+        dict
+            with keys ``n``, ``iteration``, ``Etot``, ``dn``, ``k``, ``wk``, ``hash``, ``history`` and ``mixer_weight``
+            (the last two are ``None`` if not stored)
+        """
+        if group is not None:
+            if group not in self.groups:
+                raise ValueError(f'group {group} does not exist in file {self._file}')
+            g = self.groups[group]
+        else:
+            g = self
+
+        state = {'hash': g.getncattr('hash')}
+        for name in ('n', 'iteration', 'Etot', 'dn', 'k', 'wk', 'history', 'mixer_weight'):
+            if name in g.variables:
+                state[name] = np.array(g.variables[name][:])
+            else:
+                state[name] = None
+        state['iteration'] = int(state['iteration'])
+        state['Etot'] = float(state['Etot'])
+        state['dn'] = float(state['dn'])
+        return state
+
 sisl.io.add_sile("HU.nc", ncSileHubbard, gzip=False)
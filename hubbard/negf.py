@@ -1,12 +1,21 @@
 import numpy as np
 from numpy import einsum, conj
+import scipy.sparse as sp
 import sisl
 import os
 import math
 from scipy.interpolate import interp1d
 from scipy.linalg import inv
+from scipy.sparse.linalg import splu
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hubbard.telemetry import _record
+from hubbard.density import _get_executor
 
 _pi = math.pi
+# Largest number of orbitals for which stacked inversions are faster than one LAPACK call per energy
+_batch_max_orbitals = 40
+# Estimated cost (relative to dense inversions) below which solver='auto' does not try further solvers
+_auto_accept_cost = 0.1
 
 __all__ = ['NEGF']
 
@@ -34,13 +43,357 @@ def _G(e, HC, elec_idx, SE):
     return inv(inv_GF)
 
 
-def _nested_list(*args):
-    if len(args) == 0:
-        return None
-    l = []
-    for _ in range(args[0]):
-        l.append(_nested_list(*args[1:]))
-    return l
+def _device_graph(H):
+    """ Sparsity pattern of the device Hamiltonian with the supercell connections folded into the unit cell """
+    no = H.sites
+    A = H.H.tocsr(0)
+    A = sp.csr_matrix((np.ones(A.nnz, dtype=np.int8), A.indices % no, A.indptr), shape=(no, no))
+    return (A + A.T).tocsr()
+
+
+class _BlockTridiagonal:
+    """ Partition of the device orbitals into the blocks of a block-tridiagonal inverse Green function
+
+    The blocks are the level sets of a breadth-first search of the orbital graph starting from the first electrode.
+    Each block only couples to the previous and next ones, since the couplings connect orbitals in the same or adjacent levels.
+    The levels spanned by the orbitals of each electrode are merged into one block (the self-energies are dense
+    in the electrode orbitals), and consecutive levels are merged into blocks of at least `min_block` orbitals
+    to limit the overhead per block.
+
+    Parameters
+    ----------
+    H: HubbardHamiltonian
+        the device
+    elec_idx: list of numpy.ndarray
+        orbitals of each electrode
+    min_block: int, optional
+        smallest number of orbitals of a block (except the last one)
+    """
+
+    def __init__(self, H, elec_idx, min_block=24):
+        if len(elec_idx) == 0:
+            raise ValueError(self.__class__.__name__ + ' requires at least one electrode to partition the device')
+        no = H.sites
+        A = _device_graph(H)
+
+        level = np.full(no, -1, dtype=np.int64)
+        front = np.unique(elec_idx[0].ravel())
+        level[front] = 0
+        nlevel = 1
+        while True:
+            nxt = np.unique(A[front].indices)
+            nxt = nxt[level[nxt] < 0]
+            if len(nxt) == 0:
+                break
+            level[nxt] = nlevel
+            nlevel += 1
+            front = nxt
+        # Orbitals not connected to the first electrode are added to the last block
+        level[level < 0] = nlevel - 1
+
+        # Boundaries between consecutive levels that can be kept
+        cut = np.ones(nlevel, dtype=bool)
+        for idx in elec_idx:
+            lv = level[idx.ravel()]
+            cut[lv.min():lv.max()] = False
+        cut[-1] = True
+        size = np.bincount(level, minlength=nlevel)
+        block_of_level = np.empty(nlevel, dtype=np.int64)
+        nblock, acc = 0, 0
+        for l in range(nlevel):
+            block_of_level[l] = nblock
+            acc += size[l]
+            if cut[l] and acc >= min_block:
+                nblock, acc = nblock + 1, 0
+        if acc == 0:
+            nblock -= 1
+        block = block_of_level[level]
+        self.blocks = [np.flatnonzero(block == b) for b in range(nblock + 1)]
+        self.no = no
+        # Block and position within the block of the orbitals of each electrode
+        pos = np.empty(no, dtype=np.int64)
+        for b in self.blocks:
+            pos[b] = np.arange(len(b))
+        self.elec_block = [int(block[idx.ravel()[0]]) for idx in elec_idx]
+        self.elec_local = [pos[idx].reshape(-1, 1) for idx in elec_idx]
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def cost(self):
+        """ Estimate of the cost of `diag` relative to a dense inversion (``no ** 3``) """
+        b = np.array([len(b) for b in self.blocks], dtype=np.float64)
+        # Two inversions and the products of the forward and backward sweeps per block, plus the overhead of the Python loop
+        flops = 2 * (b ** 3).sum() + 3 * (b[:-1] ** 2 * b[1:] + b[:-1] * b[1:] ** 2).sum() + 2e4 * len(b)
+        return flops / float(self.no) ** 3
+
+    def split(self, HC):
+        """ Diagonal, upper and lower blocks of the dense matrix `HC` """
+        bl = self.blocks
+        Hd = [HC[np.ix_(b, b)] for b in bl]
+        Hu = [HC[np.ix_(b0, b1)] for b0, b1 in zip(bl[:-1], bl[1:])]
+        Hl = [HC[np.ix_(b1, b0)] for b0, b1 in zip(bl[:-1], bl[1:])]
+        return Hd, Hu, Hl
+
+    def _inverse_blocks(self, e, HCb, SE):
+        """ Diagonal blocks of the inverse Green function ``e - HC - SE`` """
+        Hd, Hu, Hl = HCb
+        Md = []
+        for H in Hd:
+            M = -H.astype(np.complex128)
+            M[np.diag_indices_from(M)] += e
+            Md.append(M)
+        for b, idx, se in zip(self.elec_block, self.elec_local, SE):
+            Md[b][idx, idx.T] -= se
+        return Md
+
+    def solve(self, e, HCb, SE, columns=()):
+        """ Diagonal (and selected columns) of the Green function with the recursive Green function method
+
+        Parameters
+        ----------
+        e: complex
+            energy
+        HCb: tuple
+            blocks of the Hamiltonian, see `split`
+        SE: list of numpy.ndarray
+            self-energies of the electrodes
+        columns: list of int, optional
+            electrodes for which the columns ``G[:, elec_idx]`` are also calculated
+
+        Returns
+        -------
+        diag: numpy.ndarray
+            diagonal of the Green function
+        cols: list of numpy.ndarray
+            columns of the Green function for the requested electrodes
+        """
+        _, Hu, Hl = HCb
+        Md = self._inverse_blocks(e, HCb, SE)
+        n = len(Md)
+        # Left-connected Green functions
+        gL = [inv(Md[0])]
+        for i in range(1, n):
+            gL.append(inv(Md[i] - Hl[i-1] @ gL[i-1] @ Hu[i-1]))
+        # Diagonal blocks of the full Green function
+        G = [None] * n
+        G[-1] = gL[-1]
+        for i in range(n - 2, -1, -1):
+            gLu = gL[i] @ Hu[i]
+            G[i] = gL[i] + gLu @ G[i+1] @ (Hl[i] @ gL[i])
+        diag = np.empty(self.no, dtype=np.complex128)
+        for b, Gi in zip(self.blocks, G):
+            diag[b] = Gi.diagonal()
+        if len(columns) == 0:
+            return diag, []
+
+        # Right-connected Green functions for the columns
+        gR = [None] * n
+        gR[-1] = inv(Md[-1])
+        for i in range(n - 2, -1, -1):
+            gR[i] = inv(Md[i] - Hu[i] @ gR[i+1] @ Hl[i])
+        cols = []
+        for ie in columns:
+            c = self.elec_block[ie]
+            col = np.empty((self.no, len(self.blocks[c])), dtype=np.complex128)
+            col[self.blocks[c]] = G[c]
+            Gjc = G[c]
+            for j in range(c + 1, n):
+                # The couplings are -Hl and -Hu in the inverse Green function
+                Gjc = gR[j] @ (Hl[j-1] @ Gjc)
+                col[self.blocks[j]] = Gjc
+            Gjc = G[c]
+            for j in range(c - 1, -1, -1):
+                Gjc = gL[j] @ (Hu[j] @ Gjc)
+                col[self.blocks[j]] = Gjc
+            cols.append(col[:, self.elec_local[ie].ravel()])
+        return diag, cols
+
+
+class _SparseLU:
+    """ Diagonal and electrode columns of the Green function from a sparse LU factorization of the inverse Green function
+
+    The sparsity pattern (Hamiltonian plus the dense electrode blocks) and a fill-reducing ordering (COLAMD) are
+    obtained once, and the inverse Green function of each energy is factorized in the permuted order with `scipy.sparse.linalg.splu`.
+    The diagonal is then obtained by solving for blocks of `chunk` unit vectors, i.e., at a cost proportional to
+    ``nnz(L + U) * no`` instead of ``no ** 3``, and without storing the full Green function.
+    This works for any device topology (e.g., multi-terminal devices), see `_BlockTridiagonal` for devices that can be partitioned
+    along a transport direction.
+
+    Parameters
+    ----------
+    H: HubbardHamiltonian
+        the device
+    elec_idx: list of numpy.ndarray
+        orbitals of each electrode
+    chunk: int, optional
+        number of columns solved at once
+    """
+
+    def __init__(self, H, elec_idx, chunk=256):
+        no = H.sites
+        self.no = no
+        self.chunk = chunk
+        A = _device_graph(H) + sp.identity(no, dtype=np.int8, format='csr')
+        for idx in elec_idx:
+            idx = idx.ravel()
+            A = A + sp.csr_matrix((np.ones(len(idx) ** 2, dtype=np.int8), (np.repeat(idx, len(idx)), np.tile(idx, len(idx)))),
+                                  shape=(no, no))
+        A = A.tocoo()
+        row, col = A.row, A.col
+
+        # Fill-reducing ordering of the pattern, order[i] is the orbital at position i
+        M = sp.csc_matrix((np.where(row == col, float(no), -1.), (row, col)), shape=(no, no))
+        self.order = np.argsort(splu(M, permc_spec='COLAMD').perm_c)
+        self.pos = np.argsort(self.order)
+
+        # Pattern in the permuted order, with the position in the data array of each matrix element
+        P = sp.csc_matrix((np.arange(1, len(row) + 1), (self.pos[row], self.pos[col])), shape=(no, no))
+        P.sort_indices()
+        self.indices, self.indptr = P.indices, P.indptr
+        element = P.data - 1
+        self.row, self.col = row[element], col[element]
+        self.diag_idx = np.flatnonzero(self.row == self.col)[np.argsort(self.row[self.row == self.col])]
+        P.data = np.arange(1, P.nnz + 1)
+        P = P.tocsr()
+        self.elec_idx = [P[np.ix_(self.pos[idx.ravel()], self.pos[idx.ravel()])].toarray() - 1 for idx in elec_idx]
+        self.elec_pos = [self.pos[idx.ravel()] for idx in elec_idx]
+
+        # Number of non-zero elements of the factors, to estimate the cost
+        M = sp.csc_matrix((np.where(self.row == self.col, float(no), -1.), self.indices, self.indptr), shape=(no, no))
+        lu = splu(M, permc_spec='NATURAL')
+        self.nnz = lu.L.nnz + lu.U.nnz
+
+    def cost(self):
+        """ Estimate of the cost of `solve` relative to a dense inversion (``no ** 3``) """
+        # Sparse triangular solves are roughly an order of magnitude slower per operation than a dense inversion
+        return 12. * self.nnz / float(self.no) ** 2
+
+    def split(self, HC):
+        """ Matrix elements of the dense matrix `HC` in the sparsity pattern """
+        return HC[self.row, self.col]
+
+    def solve(self, e, HCs, SE, columns=()):
+        """ Diagonal (and selected columns) of the Green function
+
+        Parameters
+        ----------
+        e: complex
+            energy
+        HCs: numpy.ndarray
+            matrix elements of the Hamiltonian, see `split`
+        SE: list of numpy.ndarray
+            self-energies of the electrodes
+        columns: list of int, optional
+            electrodes for which the columns ``G[:, elec_idx]`` are also calculated
+
+        Returns
+        -------
+        diag: numpy.ndarray
+            diagonal of the Green function
+        cols: list of numpy.ndarray
+            columns of the Green function for the requested electrodes
+        """
+        no = self.no
+        data = -HCs.astype(np.complex128)
+        data[self.diag_idx] += e
+        for idx, se in zip(self.elec_idx, SE):
+            data[idx] -= se
+        lu = splu(sp.csc_matrix((data, self.indices, self.indptr), shape=(no, no)), permc_spec='NATURAL')
+
+        diag = np.empty(no, dtype=np.complex128)
+        for j0 in range(0, no, self.chunk):
+            j1 = min(j0 + self.chunk, no)
+            rhs = np.zeros((no, j1 - j0), dtype=np.complex128)
+            rhs[np.arange(j0, j1), np.arange(j1 - j0)] = 1.
+            X = lu.solve(rhs)
+            diag[self.order[j0:j1]] = X[np.arange(j0, j1), np.arange(j1 - j0)]
+        cols = []
+        for ie in columns:
+            pos = self.elec_pos[ie]
+            rhs = np.zeros((no, len(pos)), dtype=np.complex128)
+            rhs[pos, np.arange(len(pos))] = 1.
+            cols.append(lu.solve(rhs)[self.pos])
+        return diag, cols
+
+
+def _self_energy_task(se, E, k, kw, out=None):
+    """ Self-energies of `se` at the energies `E` and k-point `k`
+
+    The self-energies are written to `out`, which is an array (shared with the calling thread) or a tuple
+    ``(fname, index)`` of a ``.npy`` file opened here as a memmap (e.g., in another process).
+    If `out` is ``None`` they are returned instead. `se` may also be the tuple ``(class, __dict__)`` of a self-energy,
+    since `sisl.SelfEnergy` instances forward unknown attributes to their parent, which breaks unpickling them
+    """
+    if isinstance(se, tuple):
+        cls, state = se
+        se = cls.__new__(cls)
+        se.__dict__.update(state)
+    if isinstance(out, tuple):
+        fname, index = out
+        out = np.lib.format.open_memmap(fname, mode='r+')[index]
+    if out is None:
+        return np.array([se.self_energy(e, k=k, **kw) for e in E])
+    for ie, e in enumerate(E):
+        out[ie] = se.self_energy(e, k=k, **kw)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return None
+
+
+class _SelfEnergyStore:
+    """ Self-energies of the electrodes for all spins, k-points and energies
+
+    The self-energies of each electrode are stored in a single contiguous array with shape ``(spin, nk, nE, ne, ne)``,
+    where ``ne`` is the number of orbitals of the electrode. Optionally the arrays are stored with
+    single precision and/or mapped to ``.npy`` files on disk (`numpy.memmap`), such that
+    they need not fit in memory.
+
+    Parameters
+    ----------
+    shape: tuple of int
+        number of spins, k-points and energies
+    sizes: list of int
+        number of orbitals of each electrode
+    dtype: numpy.dtype, optional
+        data type of the stored self-energies
+    fname: str, optional
+        if given, the self-energies of electrode ``i`` are stored in the file ``{fname}.{i}.npy``
+    """
+
+    def __init__(self, shape, sizes, dtype=np.complex128, fname=None):
+        dtype = np.dtype(dtype)
+        if dtype not in (np.complex64, np.complex128):
+            raise ValueError(self.__class__.__name__ + f' requires a complex data type, got {dtype}')
+        self.fname = fname
+        self.data = []
+        for i, ne in enumerate(sizes):
+            shape_i = tuple(shape) + (ne, ne)
+            if fname is None:
+                self.data.append(np.empty(shape_i, dtype=dtype))
+            else:
+                self.data.append(np.lib.format.open_memmap(self.file(i), mode='w+', dtype=dtype, shape=shape_i))
+
+    def file(self, i):
+        """ Name of the file storing the self-energies of electrode `i` (``None`` if stored in memory) """
+        if self.fname is None:
+            return None
+        return f'{self.fname}.{i}.npy'
+
+    @property
+    def nbytes(self):
+        """ Size of the stored self-energies (in bytes) """
+        return sum(d.nbytes for d in self.data)
+
+    def __call__(self, spin, ik, ie):
+        """ List of the self-energies of all electrodes at spin, k-point and energy index `ie` (an integer or a slice) """
+        return [d[spin, ik, ie] for d in self.data]
+
+    def flush(self):
+        """ Write the self-energies to disk (if stored in files) """
+        for d in self.data:
+            if isinstance(d, np.memmap):
+                d.flush()
 
 
 class NEGF:
@@ -63,6 +416,33 @@ class NEGF:
         name of the file containing the energy contour in the complex plane to integrate the density matrix
     V: float, optional
         applied bias between the two electrodes
+    solver: {'auto', 'dense', 'rgf', 'lu'}, optional
+        method to obtain the Green functions. ``'dense'`` inverts the full inverse Green function at each energy, while
+        ``'rgf'`` partitions the device into blocks along the transport direction (starting from the first electrode)
+        and uses the recursive Green function method, whose cost is linear in the length of the device.
+        ``'lu'`` uses sparse LU factorizations (in a fill-reducing order), which is suited for devices that cannot be
+        partitioned efficiently, e.g., with several electrodes.
+        ``'auto'`` uses the method with the lowest estimated cost, and ``'dense'`` for devices without electrodes
+    batch_memory: int, optional
+        memory (in bytes) available to solve the Green functions of several contour points at once with stacked LAPACK calls,
+        used by the ``'dense'`` solver. This avoids the Python overhead per contour point for small devices
+        (for larger ones the stacked inversions are slower than separate ones and are not used).
+        ``0`` solves one point at a time
+    SE_dtype: {numpy.complex128, numpy.complex64}, optional
+        data type in which the precomputed self-energies are stored. Single precision halves the memory
+        at the cost of the precision of the self-energies (about 7 digits)
+    SE_file: str, optional
+        store the precomputed self-energies of electrode ``i`` in the file ``{SE_file}.{i}.npy`` (a `numpy.memmap`)
+        instead of in memory, for calculations with many k-points, spins and energies
+    executor: None, str or concurrent.futures.Executor, optional
+        ``'thread'`` or ``'process'`` to create a pool, or an existing executor, over which the precomputation of the
+        self-energies is distributed (one task per electrode, k-point and spin).
+        Threads write directly into the stored arrays. Processes do the same for the files of `SE_file`,
+        otherwise their results are copied back
+    max_workers: int, optional
+        number of workers of the pool created for `executor`
+    print_info: bool, optional
+        print the progress of the precomputation of the self-energies
 
 
     Examples
@@ -79,7 +459,8 @@ class NEGF:
     This class has to be generalized to non-orthogonal basis
     """
 
-    def __init__(self, Hdev, elec_SE, elec_idx, CC=None, V=0, **kwargs):
+    def __init__(self, Hdev, elec_SE, elec_idx, CC=None, V=0, solver='auto', batch_memory=2**27,
+                 SE_dtype=np.complex128, SE_file=None, executor=None, max_workers=None, print_info=False, **kwargs):
         """ Initialize NEGF class """
 
         # Global charge neutral reference energy (conveniently named fermi)
@@ -143,12 +524,37 @@ class NEGF:
 
         # convert all matrices to a sisl.SelfEnergy instance
         self.elec_SE = list(map(convert2SelfEnergy, elec_SE, self.mu))
-        self.elec_idx = [np.array(idx).reshape(-1, 1) for idx in elec_idx]
+        # Negative indices count from the end of the device
+        self.elec_idx = [np.array(idx).reshape(-1, 1) % Hdev.sites for idx in elec_idx]
 
         # Ensure commensurate shapes
         for SE, idx in zip(self.elec_SE, self.elec_idx):
             assert len(SE) == len(idx)
 
+        if solver not in ('auto', 'dense', 'rgf', 'lu'):
+            raise ValueError(self.__class__.__name__ + f' does not implement solver={solver}')
+        # Object providing the Green functions, None for dense inversions
+        self._solver = None
+        if solver == 'rgf':
+            self._solver = _BlockTridiagonal(Hdev, self.elec_idx)
+        elif solver == 'lu':
+            self._solver = _SparseLU(Hdev, self.elec_idx)
+        elif solver == 'auto' and len(self.elec_idx) > 0:
+            # The candidates are only built until one is cheap enough, devices that cannot be
+            # partitioned use the next candidate (or dense inversions)
+            cost = 1.
+            for cls in (_BlockTridiagonal, _SparseLU):
+                try:
+                    candidate = cls(Hdev, self.elec_idx)
+                except ValueError:
+                    continue
+                if candidate.cost() < cost:
+                    self._solver, cost = candidate, candidate.cost()
+                if cost < _auto_accept_cost:
+                    break
+        self.solver = {type(None): 'dense', _BlockTridiagonal: 'rgf', _SparseLU: 'lu'}[type(self._solver)]
+        self.batch_memory = batch_memory
+
         # For a bias calcualtion, ensure that only the first
         # two electrodes are RecursiveSI (all others should be WideBandSE)
         if self.NEQ:
@@ -165,32 +571,102 @@ class NEGF:
             # since the electrodes more govern the DOS.
             self.eta = 1.
 
-        # spin, k-sampling, electrode
-        self._ef_SE = _nested_list(Hdev.spin_size, len(Hdev.mp.k), len(self.elec_SE))
-        # spin, k-sampling, EQ-contour, energy, electrode
-        self._cc_eq_SE = _nested_list(Hdev.spin_size, len(Hdev.mp.k), *self.CC_eq.shape, len(self.elec_SE))
-        # spin, k-sampling, energy, electrode
-        self._cc_neq_SE = _nested_list(Hdev.spin_size, len(Hdev.mp.k), self.CC_neq.shape[0], len(self.elec_SE))
-
-        kw = {}
-        for i, se in enumerate(self.elec_SE):
-            for ik, k in enumerate(Hdev.mp.k):
-                for spin in range(Hdev.spin_size):
-                    # Map self-energy at the Fermi-level of each electrode into the device region
-                    if Hdev.spin_size > 1:
-                        kw = {'spin':spin}
-
-                    self._ef_SE[spin][ik][i] = se.self_energy(1j * self.eta, k=k, **kw)
+        # All energies at which the self-energies are needed: the Fermi-level (for the charge correction),
+        # all points of the EQ contours and the points of the NEQ contour
+        self._SE_E = np.concatenate([[1j * self.eta], self.CC_eq.ravel(), self.CC_neq])
+        n_eq = self.CC_eq.shape[1]
+        # Index of the energies in the store
+        self._ef_i = 0
+        self._eq_i = [slice(1 + c * n_eq, 1 + (c + 1) * n_eq) for c in range(len(self.CC_eq))]
+        self._neq_i = slice(1 + self.CC_eq.size, len(self._SE_E))
+        # spin, k-sampling, energy (one array per electrode)
+        self._SE = _SelfEnergyStore((Hdev.spin_size, len(Hdev.mp.k), len(self._SE_E)),
+                                    [len(idx) for idx in self.elec_idx], dtype=SE_dtype, fname=SE_file)
+        self._calc_SE(Hdev.mp.k, Hdev.spin_size, executor, max_workers, print_info)
+
+    def _calc_SE(self, k, spin_size, executor=None, max_workers=None, print_info=False):
+        """ Map the self-energy of each electrode into the device region at all energies of `_SE_E`
+
+        One task per electrode, k-point and spin, optionally distributed over the workers of `executor`
+        """
+        tasks = [(i, ik, spin) for i in range(len(self.elec_SE)) for ik in range(len(k)) for spin in range(spin_size)]
+        pool, shutdown = _get_executor(executor, max_workers)
+        processes = pool is not None and not isinstance(pool, ThreadPoolExecutor)
+
+        def args(i, ik, spin):
+            kw = {'spin': spin} if spin_size > 1 else {}
+            se = self.elec_SE[i]
+            if processes:
+                se = (type(se), se.__dict__)
+                # Processes can only share the memmaps on disk
+                fname = self._SE.file(i)
+                out = None if fname is None else (fname, (spin, ik))
+            else:
+                out = self._SE.data[i][spin, ik]
+            return se, self._SE_E, k[ik], kw, out
+
+        def report(done):
+            if print_info and (done == len(tasks) or done % max(1, len(tasks) // 10) == 0):
+                print(f'   NEGF: self-energies of {done}/{len(tasks)} electrodes x k-points x spins')
+
+        try:
+            if pool is None:
+                for done, task in enumerate(tasks, 1):
+                    _self_energy_task(*args(*task))
+                    report(done)
+            else:
+                futures = {pool.submit(_self_energy_task, *args(*task)): task for task in tasks}
+                for done, f in enumerate(as_completed(futures), 1):
+                    SE = f.result()
+                    if SE is not None:
+                        i, ik, spin = futures[f]
+                        self._SE.data[i][spin, ik] = SE
+                    report(done)
+        finally:
+            if shutdown:
+                pool.shutdown()
+        self._SE.flush()
+
+    def _split(self, HC):
+        """ Hamiltonian of the device in the form used by the Green function solver """
+        if self._solver is None:
+            return HC
+        return self._solver.split(HC)
+
+    def _G_diag(self, e, HCs, SE, columns=()):
+        """ Diagonal of the Green function (and its columns for the electrodes in `columns`) at energy `e`
+
+        `HCs` is the Hamiltonian returned by `_split`
+        """
+        if self._solver is None:
+            GF = _G(e, HCs, self.elec_idx, SE)
+            return GF.diagonal().copy(), [GF[:, self.elec_idx[i].ravel()] for i in columns]
+        return self._solver.solve(e, HCs, SE, columns)
 
-                    for cc_eq_i, CC_eq in enumerate(self.CC_eq):
-                        for ic, cc in enumerate(CC_eq):
-                            # Do it also for each point in the CC, for all EQ CC
-                            self._cc_eq_SE[spin][ik][cc_eq_i][ic][i] = se.self_energy(cc, k=k, **kw)
+    def _G_diag_batch(self, E, HCs, SE):
+        """ Diagonals of the Green functions at the energies `E` as an array with shape ``(len(E), no)``
 
-                    if self.NEQ:
-                        for ic, cc in enumerate(self.CC_neq):
-                            # And for each point in the Neq CC
-                            self._cc_neq_SE[spin][ik][ic][i] = se.self_energy(cc, k=k, **kw)
+        `SE` contains the self-energies of each electrode at all energies (arrays with shape ``(len(E), ne, ne)``).
+        With the dense solver the energies are solved in batches limited by `batch_memory`
+        """
+        if self._solver is not None or len(HCs) > _batch_max_orbitals:
+            return np.array([self._G_diag(e, HCs, [se[ie] for se in SE])[0] for ie, e in enumerate(E)])
+        no = len(HCs)
+        # The stacked matrices, their inverses and the LAPACK work arrays
+        nbatch = int(self.batch_memory // (3 * 16 * no ** 2))
+        if nbatch < 2:
+            return np.array([self._G_diag(e, HCs, [se[ie] for se in SE])[0] for ie, e in enumerate(E)])
+        diag = np.empty((len(E), no), dtype=np.complex128)
+        idx = np.arange(no)
+        for i0 in range(0, len(E), nbatch):
+            i1 = min(i0 + nbatch, len(E))
+            inv_GF = np.empty((i1 - i0, no, no), dtype=np.complex128)
+            inv_GF[:] = -HCs
+            inv_GF[:, idx, idx] += np.asarray(E[i0:i1]).reshape(-1, 1)
+            for ie, elec_idx in enumerate(self.elec_idx):
+                inv_GF[:, elec_idx, elec_idx.T] -= SE[ie][i0:i1]
+            diag[i0:i1] = np.linalg.inv(inv_GF)[:, idx, idx]
+        return diag
 
     def calc_n_open(self, H, q, qtol=1e-5):
         """
@@ -218,11 +694,13 @@ class NEGF:
         q = np.asarray(q).sum()
 
         # Create short-hands
-        ef_SE = self._ef_SE
-        cc_eq_SE = self._cc_eq_SE
+        SE = self._SE
 
         no = len(H.H)
         ni = np.empty([H.spin_size, no], dtype=np.float64)
+        # The Hamiltonian matrices are reused from the Bloch-matrix cache of H (only their diagonal changes
+        # between SCF iterations), see `hubbard.HubbardHamiltonian.set_bloch_cache`
+        revision = H._hk_revision()
         ntot = -1.
         Ef = self.Ef
 
@@ -262,14 +740,11 @@ class NEGF:
                     # Calculate charge at the Fermi-level
                     f = 0.
                     for spin in range(H.spin_size):
-                        for ik, k in enumerate(H.mp.k):
-                            if H.spin_size == 2:
-                                HC = H.H.Hk(spin=spin, k=k, format='array')
-                            else:
-                                HC = H.H.Hk(k=k, format='array')
+                        for ik, [wk, k] in enumerate(zip(H.mp.weight, H.mp.k)):
+                            HC = self._split(H._Hk(k, spin, revision))
                             cc = Ef + 1j * self.eta
 
-                            GF = _G(cc, HC, self.elec_idx, ef_SE[spin][ik])
+                            GF, _ = self._G_diag(cc, HC, SE(spin, ik, self._ef_i))
 
                             # Now we need to calculate the new Fermi level based on the
                             # difference in charge and by estimating the current Fermi level
@@ -278,26 +753,23 @@ class NEGF:
                             #   F(x) - F(0) = arctan(x) / pi = dq
                             # In our case we *know* that 0.5 = - Im[Tr(Gf)] / \pi
                             # and consider this a pre-factor
-                            f -= np.trace(GF).imag * wk / _pi # Integrate over k-space with weight wk
+                            f -= GF.sum().imag * wk / _pi # Integrate over k-space with weight wk
 
-                        # calculate fractional change
-                        f = dq / f
-                        # Since x above is in units of eta, we have to multiply with eta
-                        if abs(f) < 0.45:
-                            Ef -= self.eta * math.tan(f * _pi) * 0.5
-                        else:
-                            Ef -= self.eta * math.tan((_pi / 2 - math.atan(1 / (f * _pi)))) * 0.5
+                    # calculate fractional change
+                    f = dq / f
+                    # Since x above is in units of eta, we have to multiply with eta
+                    if abs(f) < 0.45:
+                        Ef -= self.eta * math.tan(f * _pi) * 0.5
+                    else:
+                        Ef -= self.eta * math.tan((_pi / 2 - math.atan(1 / (f * _pi)))) * 0.5
 
             Etot = 0.
             for spin in range(H.spin_size):
                 # Loop k-points and weights
-                D = np.zeros([len(self.CC_eq), no], dtype=np.complex128)
+                D = np.zeros(no, dtype=np.complex128)
                 for ik, [wk, k] in enumerate(zip(H.mp.weight, H.mp.k)):
-                    Dk = np.zeros_like(D) # Density matrix per k point
-                    if H.spin_size==2:
-                        HC = H.H.Hk(spin=spin, k=k, format='array')
-                    else:
-                        HC = H.H.Hk(k=k, format='array')
+                    Dk = np.zeros([len(self.CC_eq), no], dtype=np.complex128) # Density matrix per k point
+                    HC = self._split(H._Hk(k, spin, revision))
                     if self.NEQ:
                         # Correct Density matrix with Non-equilibrium integrals
                         Delta, w = self.Delta(HC, Ef, ik, spin=spin)
@@ -315,20 +787,19 @@ class NEGF:
 
                     # Loop over all eq. Contours
                     for cc_eq_i, CC in enumerate(self.CC_eq):
-                        for ic, [cc, wi] in enumerate(zip(CC + Ef, self.w_eq)):
-
-                            GF = _G(cc, HC, self.elec_idx, cc_eq_SE[spin][ik][cc_eq_i][ic])
+                        cc = CC + Ef
+                        GF = self._G_diag_batch(cc, HC, SE(spin, ik, self._eq_i[cc_eq_i]))
 
-                            # Greens function evaluated at each point of the CC multiplied by the weight
-                            Gf_wi = - np.diag(GF) * wi
-                            Dk[cc_eq_i] += Gf_wi.imag
+                        # Greens function evaluated at each point of the CC multiplied by the weight
+                        Gf_wi = - GF * self.w_eq.reshape(-1, 1)
+                        Dk[cc_eq_i] += Gf_wi.imag.sum(0)
 
-                            # Integrate density of states to obtain the total energy
-                            # For the non equilibrium energy maybe we could obtain it as in PRL 70, 14 (1993)
-                            if cc_eq_i == 0:
-                                Etot += ((w * Gf_wi).sum() * cc).imag * wk # Integrate over k-space with weight wk
-                            else:
-                                Etot += (((1 - w) * Gf_wi).sum() * cc).imag * wk # Integrate over k-space with weight wk
+                        # Integrate density of states to obtain the total energy
+                        # For the non equilibrium energy maybe we could obtain it as in PRL 70, 14 (1993)
+                        if cc_eq_i == 0:
+                            Etot += (einsum('ei,i->e', Gf_wi, np.broadcast_to(w, no)) * cc).imag.sum() * wk # Integrate over k-space with weight wk
+                        else:
+                            Etot += (einsum('ei,i->e', Gf_wi, np.broadcast_to(1 - w, no)) * cc).imag.sum() * wk # Integrate over k-space with weight wk
 
                     if self.NEQ:
                         Dk = w * Dk[0] + (1 - w) * Dk[1]
@@ -344,6 +815,7 @@ class NEGF:
 
         # Save Fermi-level of the device
         self.Ef = Ef
+        _record(H, Ef=float(Ef))
 
         # Return spin densities and total energy, if the Hamiltonian is not spin-polarized
         # multiply Etot by 2 for spin degeneracy
@@ -355,8 +827,8 @@ class NEGF:
 
         Parameters
         ----------
-        HC: numpy.ndarray
-            Hamiltonian of the central region in its matrix form
+        HC: numpy.ndarray or tuple
+            Hamiltonian of the central region in its matrix form (or as split for the Green function solver)
         Ef: float
             Potential of the device
         ik: int
@@ -375,18 +847,24 @@ class NEGF:
             # Product of (Ndev, Nelec) x (Nelec, Nelec) x (Nelec, Ndev)
             return np.dot(G, np.dot(Gamma, np.conjugate(G.T)))
 
-        no = len(HC)
+        if self._solver is None:
+            no = len(HC)
+        else:
+            no = self._solver.no
+            if isinstance(HC, np.ndarray) and HC.ndim == 2:
+                HC = self._split(HC)
         Delta = np.zeros([2, no, no], dtype=np.complex128)
-        cc_neq_SE = self._cc_neq_SE[spin][ik]
+        cc_neq_SE = self._SE(spin, ik, self._neq_i)
 
         for ic, cc in enumerate(self.CC_neq + Ef):
 
-            GF = _G(cc, HC, self.elec_idx, cc_neq_SE[ik][ic])
+            SE_ic = [se[ic] for se in cc_neq_SE]
+            _, GF = self._G_diag(cc, HC, SE_ic, columns=(0, 1))
 
             # Elec (0, 1) are (left, right)
             # only do for the first two!
-            for i, SE in enumerate(cc_neq_SE[ik][ic][:2]):
-                Delta[i] += spectral(GF[:, self.elec_idx[i].ravel()], SE) * self.w_neq[i, ic]
+            for i, SE in enumerate(SE_ic[:2]):
+                Delta[i] += spectral(GF[i], SE) * self.w_neq[i, ic]
 
         # Firstly implement it for two terminals following PRB 65 165401 (2002)
         # then we can think of implementing it for N terminals as in Com. Phys. Comm. 212 8-24 (2017)
@@ -423,14 +901,14 @@ class NEGF:
 
         dos = np.zeros([len(E)])
         for ispin in spin:
-            HC = H.H.Hk(spin=ispin, format='array')
+            HC = self._split(H.H.Hk(spin=ispin, format='array'))
             for i, e in enumerate(E):
 
                 # Append all the self-energies for the electrodes at each energy point
                 SE = [se.self_energy(e, spin=ispin) for se in self.elec_SE]
-                GF = _G(e + 1j * eta, HC, self.elec_idx, SE)
+                GF, _ = self._G_diag(e + 1j * eta, HC, SE)
 
-                dos[i] -= np.trace(GF).imag
+                dos[i] -= GF.sum().imag
 
         return dos / np.pi
 
@@ -465,10 +943,10 @@ class NEGF:
 
         ldos = np.zeros([len(E), len(H.H)])
         for ispin in spin:
-            HC = H.H.Hk(spin=ispin, format='array')
+            HC = self._split(H.H.Hk(spin=ispin, format='array'))
             for i, e in enumerate(E):
                 SE = [se.self_energy(e, spin=ispin) for se in self.elec_SE]
-                GF = _G(e + 1j * eta, HC, self.elec_idx, SE)
-                ldos[i] -= GF.diagonal().imag
+                GF, _ = self._G_diag(e + 1j * eta, HC, SE)
+                ldos[i] -= GF.imag
 
         return ldos / np.pi
@@ -0,0 +1,127 @@
+import warnings
+import numpy as np
+import scipy.sparse as sp
+from hubbard.kpm import _spectral_bounds
+
+__all__ = ['calc_n_purification']
+
+
+def _drop(X, drop_tol):
+    """ Remove the matrix elements of `X` smaller than `drop_tol` (in-place) """
+    if drop_tol > 0:
+        X.data[np.abs(X.data) < drop_tol] = 0
+        X.eliminate_zeros()
+    return X
+
+
+def _trs4(Hk, ne, tol, drop_tol, max_iter):
+    r""" Trace-resetting fourth-order (TRS4) purification of the density matrix of `Hk` with `ne` occupied states
+
+    Returns
+    -------
+    X: scipy.sparse.csr_matrix
+        the (approximately) idempotent density matrix
+    niter: int
+        number of iterations used
+    converged: bool
+        whether the idempotency error is below `tol`
+    """
+    no = Hk.shape[0]
+    emin, emax = _spectral_bounds(Hk)
+    eye = sp.identity(no, dtype=Hk.dtype, format='csr')
+    # The spectrum of X is mapped into [0, 1] with the occupied states close to 1
+    X = (emax * eye - Hk) * (1. / (emax - emin))
+
+    for it in range(1, max_iter + 1):
+        X2 = _drop(X @ X, drop_tol)
+        # Idempotency error, Tr[X - X^2] vanishes for a projector
+        trX = X.diagonal().sum().real
+        trX2 = X2.diagonal().sum().real
+        if abs(trX - trX2) < tol:
+            return X, it, True
+        # Tr[X^3] and Tr[X^4] without forming the products
+        trX3 = X2.multiply(X.T).sum().real
+        trX4 = X2.multiply(X2.T).sum().real
+        trF = 4 * trX3 - 3 * trX4
+        trG = trX2 - 2 * trX3 + trX4
+        if trG > np.finfo(np.float64).eps * no:
+            gamma = (ne - trF) / trG
+        else:
+            # Close to idempotency the trace correction is dominated by round-off
+            gamma = 0.
+        if gamma > 6:
+            X = 2 * X - X2
+        elif gamma < 0:
+            X = X2
+        else:
+            X = X2 @ ((4 - 2 * gamma) * X + (gamma - 3) * X2) + gamma * X2
+        X = _drop(X.tocsr(), drop_tol)
+    return X, max_iter, False
+
+
+def calc_n_purification(H, q, tol=1e-8, drop_tol=1e-7, max_iter=100):
+    r""" Method to obtain the spin-densities of *insulators* at *T=0* by sparse density-matrix purification
+
+    The density matrix :math:`P_\sigma(k)` is obtained without diagonalization as the idempotent projector onto the lowest
+    ``q[spin]`` states with the trace-resetting fourth-order (TRS4) purification [1]_ of the sparse Hamiltonian:
+
+    .. math::
+        X_{n+1} = X_n^2(4X_n - 3X_n^2) + \gamma_n X_n^2(1-X_n)^2
+
+    where :math:`\gamma_n` is chosen such that :math:`\mathrm{Tr}[X_{n+1}] = q_\sigma`.
+    Matrix elements below `drop_tol` are removed after each product, such that for gapped systems, where the
+    density matrix decays exponentially, the cost and memory scale linearly with the number of orbitals.
+
+    The densities are :math:`\langle n_{i\sigma}\rangle = \sum_k w_k P_{ii\sigma}(k)` and the band energy
+    :math:`\sum_k w_k\mathrm{Tr}[P_\sigma(k) H_\sigma(k)]`.
+
+    Parameters
+    ----------
+    H: HubbardHamiltonian
+        `hubbard.HubbardHamiltonian` object of the system to obtain the spin-densities from
+    q: array_like
+        charge resolved in spin channels (first index for up-electrons and second index for down-electrons)
+    tol: float, optional
+        tolerance of the idempotency error :math:`\mathrm{Tr}[X - X^2]`
+    drop_tol: float, optional
+        threshold below which the density matrix elements are discarded
+    max_iter: int, optional
+        maximum number of purification iterations, a warning is issued if the idempotency error
+        is still above `tol` after them
+
+    Notes
+    -----
+    Only orthogonal basis sets are implemented. The number of iterations grows logarithmically with
+    the inverse of the (relative) band gap, for metallic systems use `hubbard.calc_n` or `hubbard.calc_n_kpm`
+
+    References
+    ----------
+    .. [1] A. M. N. Niklasson, Phys. Rev. B 66, 155115 (2002)
+
+    See Also
+    ------------
+    calc_n_insulator: equivalent method based on the direct diagonalization of the Hamiltonian
+    """
+    if not H.H.orthogonal:
+        raise ValueError('calc_n_purification is only implemented for orthogonal basis sets')
+
+    ni = np.zeros((H.spin_size, H.sites))
+    Etot = 0
+
+    for w, k in zip(H.mp.weight, H.mp.k):
+        for s in range(H.spin_size):
+            if H.spin_size > 1:
+                Hk = H.H.Hk(k=k, spin=s, format='csr')
+            else:
+                Hk = H.H.Hk(k=k, format='csr')
+            P, _, converged = _trs4(Hk, q[s], tol, drop_tol, max_iter)
+            if not converged:
+                warnings.warn(f'calc_n_purification: the density matrix of k={k} and spin={s} did not reach '
+                              f'the idempotency tolerance {tol} in {max_iter} iterations')
+
+            ni[s] += P.diagonal().real * w
+
+            # Calculate total energy, Tr[P H]
+            Etot += P.multiply(Hk.T).sum().real * w
+
+    return ni, (2./H.spin_size)*Etot
@@ -0,0 +1,178 @@
+import numpy as np
+import itertools
+from scipy.spatial import cKDTree
+
+__all__ = []
+
+# Resolution of the fractional bond vectors used to match matrix elements
+_bond_res = 1e-4
+
+
+def _wrap(f, periodic, tol=1e-5):
+    """ Wrap the fractional coordinates `f` into [0, 1) along the periodic lattice directions """
+    f = f.copy()
+    f[:, periodic] -= np.floor(f[:, periodic] + tol)
+    return f
+
+
+def _lattice_rotations(cell, periodic, tol=1e-5):
+    r""" Integer matrices :math:`M` (in fractional coordinates, acting as ``f @ M``) that preserve the metric of `cell`
+
+    Periodic and non-periodic lattice directions are never mixed
+    """
+    M = np.array(list(itertools.product((-1, 0, 1), repeat=9)), dtype=np.float64).reshape(-1, 3, 3)
+    mixed = np.outer(periodic, ~periodic)
+    mixed = mixed | mixed.T
+    M = M[~np.any(M[:, mixed], axis=1)]
+    M = M[np.isclose(np.abs(np.linalg.det(M)), 1)]
+    G = cell @ cell.T
+    MGM = np.einsum('aij,jk,alk->ail', M, G, M)
+    return list(M[np.all(np.isclose(MGM, G, rtol=0, atol=tol * np.abs(G).max()), axis=(1, 2))])
+
+
+def _atom_permutation(f, M, tau, periodic, tree, cell, tol):
+    """ Atom permutation for the operation ``f @ M + tau``, or ``None`` if it does not map the atoms onto each other """
+    fp = _wrap(f @ M + tau, periodic)
+    dist, idx = tree.query(fp @ cell, distance_upper_bound=tol)
+    if np.isinf(dist).any():
+        return None
+    return idx
+
+
+def _matrix_elements(H, atom_f):
+    """ Matrix elements of `H` with their orbitals and (fractional) bond vectors """
+    import sisl._array as _a
+    geom = H.geometry
+    csr = H._csr
+    row = np.repeat(np.arange(geom.no), csr.ncol)
+    idx = _a.array_arange(csr.ptr[:-1], n=csr.ncol)
+    col = csr.col[idx]
+    isc = col // geom.no
+    col = col % geom.no
+    d = atom_f[geom.o2a(col)] + geom.sc_off[isc] - atom_f[geom.o2a(row)]
+    return row, col, d, csr._D[idx]
+
+
+def symmetry_operations(HH, tol=1e-5):
+    r""" Spatial symmetry operations that leave a `hubbard.HubbardHamiltonian` invariant
+
+    An operation maps the atoms onto each other, and must conserve the species, ``U``, the spin densities
+    and the matrix elements of the tight-binding Hamiltonian (including the overlap).
+
+    Parameters
+    ----------
+    HH: HubbardHamiltonian
+        the system
+    tol: float, optional
+        tolerance for the positions (in Ang) and the matrix elements
+
+    Returns
+    -------
+    rotations: list of numpy.ndarray
+        integer rotation matrices acting on fractional coordinates as ``f @ M``
+    perms: numpy.ndarray
+        orbital permutations, ``perms[g, i]`` is the orbital onto which orbital ``i`` is mapped
+    """
+    geom = HH.geometry
+    cell = geom.cell
+    periodic = np.asarray(geom.nsc) > 1
+    f = _wrap(geom.fxyz, periodic)
+    tree = cKDTree(f @ cell)
+    na = geom.na
+
+    # Properties per atom that have to be conserved
+    U = np.broadcast_to(HH.U, (HH.sites,))
+    props = np.column_stack([geom.atoms.specie, geom.orbitals,
+                             U[geom.firsto[:-1]], HH.n[:, geom.firsto[:-1]].T])
+    # Onsite elements of orbitals
+    props_o = np.column_stack([U, HH.n.T])
+
+    row, col, d, D = _matrix_elements(HH.TBHam, f)
+    elements = {}
+    for i, j, dd, v in zip(row, col, np.round(d / _bond_res).astype(np.int64), D):
+        elements[(i, j, *dd)] = v
+
+    # Use the least frequent specie to limit the number of translations to try
+    species, counts = np.unique(geom.atoms.specie, return_counts=True)
+    ref = np.flatnonzero(geom.atoms.specie == species[counts.argmin()])[0]
+    candidates = np.flatnonzero(np.all(np.isclose(props, props[ref], atol=tol), axis=1))
+
+    rotations, perms = [], []
+    for M in _lattice_rotations(cell, periodic, tol):
+        for j in candidates:
+            tau = f[j] - f[ref] @ M
+            pa = _atom_permutation(f, M, tau, periodic, tree, cell, tol)
+            if pa is None or not np.allclose(props[pa], props, atol=tol):
+                continue
+            # Map orbitals of atom ia onto the same orbitals of atom pa[ia]
+            po = np.concatenate([np.arange(geom.firsto[pa[ia]], geom.firsto[pa[ia]] + geom.atoms[ia].no) for ia in range(na)])
+            if not np.allclose(props_o[po], props_o, atol=tol):
+                continue
+            dM = np.round((d @ M) / _bond_res).astype(np.int64)
+            ok = True
+            for i, jj, dd, v in zip(po[row], po[col], dM, D):
+                w = elements.get((i, jj, *dd))
+                if w is None or not np.allclose(v, w, atol=tol):
+                    ok = False
+                    break
+            if ok:
+                rotations.append(M)
+                perms.append(po)
+                break
+    return rotations, np.array(perms)
+
+
+def reduce_kmesh(k, weight, rotations, trs=True, tol=1e-6):
+    r""" Reduce the k-points to the irreducible set under the rotations (and time-reversal)
+
+    Rotations that do not map the k-points onto each other are discarded.
+
+    Parameters
+    ----------
+    k: numpy.ndarray
+        k-points in reduced coordinates
+    weight: numpy.ndarray
+        weights of the k-points
+    rotations: list of numpy.ndarray
+        rotation matrices acting on fractional coordinates as ``f @ M``
+    trs: bool, optional
+        whether time-reversal symmetry (:math:`k \leftrightarrow -k`) is also used
+
+    Returns
+    -------
+    k: numpy.ndarray
+        irreducible k-points
+    weight: numpy.ndarray
+        weights of the irreducible k-points
+    used: numpy.ndarray
+        indices of the used rotations
+    """
+    def keys(kk):
+        kk = np.round(kk / tol).astype(np.int64)
+        n = int(round(1 / tol))
+        return [tuple(x) for x in kk % n]
+
+    index = {key: i for i, key in enumerate(keys(k))}
+    images, used = [], []
+    for g, M in enumerate(rotations):
+        # k-points transform with the inverse transpose of the operation on fractional coordinates
+        kg = k @ np.linalg.inv(M).T
+        idx = [index.get(key, -1) for key in keys(kg)]
+        if -1 in idx:
+            continue
+        used.append(g)
+        images.append(idx)
+        if trs:
+            images.append([index.get(key, -1) for key in keys(-kg)])
+    images = np.array(images)
+
+    irr = np.full(len(k), -1)
+    for ik in range(len(k)):
+        if irr[ik] < 0:
+            orbit = images[:, ik]
+            orbit = orbit[orbit >= 0]
+            irr[orbit] = ik
+            irr[ik] = ik
+    ik = np.unique(irr)
+    w = np.bincount(irr, weights=weight, minlength=len(k))[ik]
+    return k[ik], w, np.array(used, dtype=np.int64)
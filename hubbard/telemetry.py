@@ -0,0 +1,158 @@
+import json
+import time
+
+__all__ = ['Telemetry']
+
+
+class _NullTimer(object):
+    # Used when no telemetry is recorded, to keep the overhead of the timed sections negligible
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, times, key):
+        self.times = times
+        self.key = key
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.times[self.key] = self.times.get(self.key, 0.) + time.perf_counter() - self.t0
+        return False
+
+
+def _timer(H, key):
+    """ Context manager timing a section of an SCF iteration of `H` into its telemetry (if enabled) """
+    telemetry = getattr(H, 'telemetry', None)
+    if telemetry is None:
+        return _null_timer
+    return telemetry.timer(key)
+
+
+def _record(H, **fields):
+    """ Add `fields` to the record of the current SCF iteration of `H` (if the telemetry is enabled) """
+    telemetry = getattr(H, 'telemetry', None)
+    if telemetry is not None:
+        telemetry.update(**fields)
+
+
+def _jsonify(value):
+    # Records only contain plain Python types such that they can be written as JSON
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {k: _jsonify(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonify(v) for v in value]
+    return value
+
+
+class Telemetry(object):
+    """ Structured per-iteration record of the self-consistent cycle of a `hubbard.HubbardHamiltonian`
+
+    When assigned to ``H.telemetry``, each call to `hubbard.HubbardHamiltonian.iterate` adds a record (a dictionary) with
+
+    - ``iteration``: the number of the record
+    - ``time``: wall times (in seconds) of the sections of the iteration. ``calc_n`` is the time spent in the method
+      obtaining the densities, of which ``eigen`` and ``fermi`` are the diagonalizations and Fermi-level search
+      (for the methods that report them), ``mixing`` and ``update`` are the time of the mixer and of
+      `hubbard.HubbardHamiltonian.update_hamiltonian`, ``total`` is the time of the iteration and ``io`` the time
+      `hubbard.HubbardHamiltonian.converge` spends on storing the densities and checkpoints after the iteration
+    - ``dn``, ``Etot``: the density change and total energy
+    - ``Ef``: the Fermi level(s), for the methods that report them
+    - ``mixer``: name, weight and number of history steps of the mixer
+
+    Without telemetry (``H.telemetry = None``, the default) the overhead in the SCF cycle is negligible.
+
+    Parameters
+    ----------
+    sink: str or file-like, optional
+        each record is also written as a line of JSON (JSON-lines format) to this file (appended) or stream
+
+    Attributes
+    ----------
+    records: list of dict
+        the records of all iterations
+
+    Examples
+    --------
+    >>> H.telemetry = Telemetry('scf.jsonl')
+    >>> H.converge(calc_n)
+    >>> sum(r['time']['eigen'] for r in H.telemetry.records)
+    """
+
+    def __init__(self, sink=None):
+        self.records = []
+        self.sink = sink
+        self._fh = None
+        self._current = None
+        self._written = True
+        self._t0 = None
+
+    def start(self):
+        """ Start the record of a new iteration """
+        self.flush()
+        self._current = {'iteration': len(self.records) + 1, 'time': {}}
+        self.records.append(self._current)
+        self._written = False
+        self._t0 = time.perf_counter()
+
+    def finish(self, **fields):
+        """ Finish the record of the current iteration by adding `fields` to it
+
+        The record can still be completed (e.g., with the time for I/O) until the next call to `start` or `flush`
+        """
+        if self._current is None:
+            return
+        self._current['time']['total'] = time.perf_counter() - self._t0
+        self.update(**fields)
+
+    def update(self, **fields):
+        """ Add `fields` to the record of the current iteration """
+        if self._current is not None:
+            self._current.update(_jsonify(fields))
+
+    def timer(self, key):
+        """ Context manager adding the wall time of a section to ``record['time'][key]`` of the current iteration """
+        if self._current is None:
+            return _null_timer
+        return _Timer(self._current['time'], key)
+
+    def flush(self):
+        """ Write the current record to the sink (if not already written) """
+        if self._written or self._current is None:
+            return
+        self._written = True
+        if self.sink is None:
+            return
+        line = json.dumps(self._current) + '\n'
+        if hasattr(self.sink, 'write'):
+            self.sink.write(line)
+        else:
+            if self._fh is None:
+                self._fh = open(self.sink, 'a')
+            self._fh.write(line)
+            self._fh.flush()
+
+    def close(self):
+        """ Flush the current record and close the sink (if opened here) """
+        self.flush()
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __getstate__(self):
+        # Copies sent to other processes (e.g., with H to a process pool) do not record anything
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
@@ -0,0 +1,209 @@
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import hubbard.hamiltonian as hh
+import hubbard.sp2 as sp2
+import hubbard.density as density
+import hubbard
+import sisl
+
+
+def zgnr(nkpt=11):
+    H = hh.HubbardHamiltonian(sp2(sisl.geom.zgnr(2)), U=3., nkpt=[nkpt, 1, 1], kT=0.025)
+    H.set_polarization([0], dn=[-1])
+    H.update_hamiltonian()
+    return H
+
+
+@pytest.mark.parametrize("method", [density.calc_n, density.calc_n_insulator])
+def test_executor(method):
+    H = zgnr()
+    n, Etot = method(H, H.q)
+    H = zgnr()
+    with ThreadPoolExecutor(2) as pool:
+        n_t, Etot_t = method(H, H.q, executor=pool)
+    H = zgnr()
+    n_p, Etot_p = method(H, H.q, executor='process', max_workers=2)
+    # Reduction is carried out in the same order
+    assert np.allclose(n, n_t, rtol=0, atol=1e-14)
+    assert np.allclose(n, n_p, rtol=0, atol=1e-14)
+    assert abs(Etot - Etot_t) < 1e-12
+    assert abs(Etot - Etot_p) < 1e-12
+
+
+def test_eigen_cache():
+    H = zgnr()
+    dist = sisl.get_distribution('fermi_dirac', smearing=H.kT)
+    assert np.allclose(H.fermi_level(), H.H.fermi_level(H.mp, q=H.q, distribution=dist))
+    # The mesh has been diagonalized by fermi_level
+    assert len(H._eig_cache) == len(H.mp.k) * 2
+    ev = H.eigh(k=H.mp.k[1], spin=1)
+    assert np.allclose(ev, H.H.eigh(k=H.mp.k[1], spin=1))
+    # Direct modifications of H.H are detected
+    H.H.shift(1.)
+    assert np.allclose(H.eigh(k=H.mp.k[1], spin=1), ev + 1.)
+    # Hamiltonian updates empty the cache
+    H.update_hamiltonian()
+    assert len(H._eig_cache) == 0
+    # Memory cap
+    H.set_eigen_cache(3 * ev.nbytes)
+    H.fermi_level()
+    assert len(H._eig_cache) == 3
+
+
+@pytest.mark.parametrize("s1", [0, 0.1])
+def test_batched(s1):
+    H = hh.HubbardHamiltonian(sp2(sisl.geom.graphene().tile(2, 0), s1=s1), U=3., nkpt=[5, 4, 1], kT=0.025)
+    H.random_density()
+    H.update_hamiltonian()
+    n, Etot = density.calc_n(H, H.q)
+    H.set_eigen_cache(0)
+    n_b, Etot_b = density.calc_n_batched(H, H.q)
+    assert np.allclose(n, n_b)
+    assert abs(Etot - Etot_b) < 1e-8
+    assert np.allclose(n_b.sum(1), H.q)
+
+
+def test_real_kpoints():
+    H = zgnr(nkpt=4)
+    k = [0.5, 0, 0]
+    assert H._is_real(k) and not H._is_real([0.25, 0, 0])
+    ev, evec = H.eigh(k=k, eigvals_only=False, spin=0)
+    assert evec.dtype == np.float64
+    assert np.allclose(ev, H.H.eigh(k=k, spin=0))
+    es = H.H.eigenstate(k, spin=0)
+    assert np.allclose(np.abs(evec.T @ es.state.T), np.eye(len(ev)), atol=1e-8)
+
+
+def test_occupied_subspace():
+    molecule = sisl.geom.agnr(7).tile(3, 0)
+    molecule.set_nsc([1, 1, 1])
+    H = hh.HubbardHamiltonian(sp2(molecule), U=3.5)
+    H.random_density()
+    H.update_hamiltonian()
+    n, Etot = density.calc_n_insulator(H, H.q)
+    # Only the occupied states are stored
+    eig, evec = H._eigh([0, 0, 0], 0, eigvals_only=False, select=(0, int(H.q[0])))
+    assert evec.shape == (H.sites, int(H.q[0]))
+    ev = [H.H.eigh(spin=s) for s in range(2)]
+    assert np.allclose(eig, ev[0][:int(H.q[0])])
+    HOMO = max(ev[s][int(H.q[s]) - 1] for s in range(2))
+    LUMO = min(ev[s][int(H.q[s])] for s in range(2))
+    assert abs(H.find_midgap() - 0.5 * (HOMO + LUMO)) < 1e-10
+    # Empty and full bands give the band edges
+    q = H.q.copy()
+    H.q = np.array([0., 0.])
+    assert np.isclose(H.find_midgap(), min(e[0] for e in ev))
+    H.q = np.array([H.sites, H.sites], dtype=np.float64)
+    assert np.isclose(H.find_midgap(), max(e[-1] for e in ev))
+    H.q = q
+    H.set_eigen_cache(0)
+    n_full, Etot_full = density.calc_n(H, H.q)
+    assert np.allclose(n, n_full, atol=1e-6)
+
+
+def test_kpm():
+    molecule = sisl.geom.graphene(orthogonal=True).tile(4, 0).tile(3, 1)
+    molecule.set_nsc([1, 1, 1])
+    H = hh.HubbardHamiltonian(sp2(molecule), U=3., kT=0.1)
+    H.random_density()
+    H.update_hamiltonian()
+    n, Etot = density.calc_n(H, H.q)
+    n_kpm, Etot_kpm = hubbard.calc_n_kpm(H, H.q, order=800, distance=8)
+    assert np.allclose(n_kpm.sum(1), H.q)
+    assert np.allclose(n, n_kpm, atol=5e-3)
+    assert abs(Etot - Etot_kpm) / abs(Etot) < 1e-3
+    # The coloring is reused for the same sparsity pattern, and recalculated when only the pattern changes
+    colors = H._kpm_probing[next(iter(H._kpm_probing))]
+    assert hubbard.kpm._probing_colors(H, 8) is colors
+    H.H._csr.col[[0, 1]] = H.H._csr.col[[1, 0]]
+    assert hubbard.kpm._probing_colors(H, 8) is not colors
+    assert len(H._kpm_probing) == 1
+
+
+def test_purification():
+    H = zgnr()
+    n, Etot = density.calc_n_insulator(H, H.q)
+    n_p, Etot_p = hubbard.calc_n_purification(H, H.q, tol=1e-10, drop_tol=0)
+    assert np.allclose(n, n_p, atol=1e-6)
+    assert abs(Etot - Etot_p) < 1e-6
+    with pytest.warns(UserWarning):
+        hubbard.calc_n_purification(H, H.q, tol=1e-10, drop_tol=0, max_iter=2)
+
+
+@pytest.mark.parametrize("geom", [sisl.geom.graphene(), sisl.geom.zgnr(2)])
+def test_irreducible_kmesh(geom):
+    H = hh.HubbardHamiltonian(sp2(geom), U=3., kT=0.05)
+    H.set_polarization([0], dn=[len(geom) - 1])
+    nkpt = [6 if nsc > 1 else 1 for nsc in geom.nsc]
+    Hirr = H.copy()
+    H.set_kmesh(nkpt)
+    Hirr.set_kmesh(nkpt, symmetry=True)
+    assert len(Hirr.mp.k) <= len(H.mp.k)
+    assert np.isclose(Hirr.mp.weight.sum(), 1)
+    for _ in range(3):
+        H.iterate(density.calc_n)
+        Hirr.iterate(density.calc_n)
+        assert np.allclose(H.n, Hirr.n)
+        assert np.isclose(H.Etot, Hirr.Etot)
+
+
+@pytest.mark.parametrize("kT", [1e-5, 0.025, 1.])
+def test_fermi_dirac(kT):
+    H = zgnr()
+    H.kT = kT
+    eig = np.array([[H.eigh(k=k, spin=s) for s in range(2)] for k in H.mp.k])
+    dist = sisl.get_distribution('fermi_dirac', smearing=kT)
+    for q in (H.q, H.q.sum()):
+        Ef, occ = density._fermi_dirac(eig, H.mp.weight, q, kT)
+        assert np.allclose((occ * H.mp.weight.reshape(-1, 1, 1)).sum((0, 2)).sum(), np.sum(q))
+        assert np.allclose(occ, dist(eig - Ef.reshape(1, -1, 1)))
+        if kT > 0.5:
+            # Unique Fermi level (not in a gap)
+            assert np.allclose(Ef, density._fermi_level(eig, H.mp.weight, q, dist), atol=1e-8)
+
+
+@pytest.mark.parametrize("method", [density.calc_n, density.calc_n_insulator])
+@pytest.mark.parametrize("executor", [None, 'thread'])
+def test_diagonalize_once(method, executor):
+    H = zgnr()
+    nsolve = [0]
+    solve = H._eigh_solve
+
+    def count(*args, **kwargs):
+        nsolve[0] += 1
+        return solve(*args, **kwargs)
+    H._eigh_solve = count
+    # Each k-point is only diagonalized once per call
+    n, Etot = method(H, H.q, executor=executor)
+    assert nsolve[0] == len(H.mp.k) * H.spin_size
+
+    # Without the eigen-cache calc_n obtains the eigenvalues first and the eigenvectors one k-point at a time
+    H.set_eigen_cache(0)
+    nsolve[0] = 0
+    n_0, Etot_0 = method(H, H.q, executor=executor)
+    assert nsolve[0] == len(H.mp.k) * H.spin_size * (2 if method is density.calc_n else 1)
+    assert np.allclose(n, n_0)
+    assert abs(Etot - Etot_0) < 1e-10
+
+
+def test_converge_ensemble():
+    Hsp2 = sp2(sisl.geom.zgnr(2))
+    U = [1., 2., 3., 4.]
+
+    def members():
+        out = [hh.HubbardHamiltonian(Hsp2, U=u, nkpt=[11, 1, 1], kT=0.025) for u in U]
+        for H in out:
+            H.set_polarization([0], dn=[-1])
+            H.update_hamiltonian()
+        return out
+    ensemble, ref = members(), members()
+    dn = hubbard.converge_ensemble(ensemble, tol=1e-10)
+    assert np.all(dn <= 1e-10)
+    for H, H_ref in zip(ensemble, ref):
+        H_ref.converge(density.calc_n, tol=1e-10)
+        assert np.allclose(H.n, H_ref.n, atol=1e-8)
+        assert np.isclose(H.Etot, H_ref.Etot)
+    with pytest.raises(ValueError):
+        hubbard.converge_ensemble([zgnr(11), zgnr(5)])
@@ -1,9 +1,13 @@
 import pytest
+import numpy as np
+import time
 
 import hubbard.hamiltonian as hh
 import hubbard.sp2 as sp2
 import hubbard.density as density
+import hubbard.ncsile as nc
 import sisl
+import hubbard
 
 
 def test_quick():
@@ -15,3 +19,232 @@ def test_quick():
     dn = H.iterate(density.calc_n_insulator, mixer=sisl.mixing.LinearMixer())
     H.write_density('test.nc')
     H.write_initspin('test.fdf')
+
+
+def test_update_hamiltonian():
+    # TB Hamiltonian without onsite elements in the sparsity pattern
+    g = sisl.geom.graphene()
+    TB = sisl.Hamiltonian(g, spin='polarized')
+    for ia in g:
+        idx = g.close(ia, R=[0.1, 1.5])[1]
+        TB[ia, idx, 0] = -2.7
+        TB[ia, idx, 1] = -2.7
+    H = hh.HubbardHamiltonian(TB, U=3.)
+    H.n = np.array([[0.8, 0.2], [0.2, 0.8]])
+    for _ in range(2):
+        H.update_hamiltonian()
+        for s in range(2):
+            assert np.allclose(H.H.tocsr(s).diagonal(), 3. * (H.n[1-s] - H.q0.mean() / 2))
+            assert np.allclose(H.H.tocsr(s).sum(1).ravel() - H.H.tocsr(s).diagonal(), -2.7 * 3)
+
+
+def test_bloch_cache():
+    H = hh.HubbardHamiltonian(sp2(sisl.geom.zgnr(2)), U=3., nkpt=[4, 1, 1])
+    H.random_density()
+    # Room for a few matrices only, the rest are built on the fly
+    H.set_bloch_cache(3 * H.sites ** 2 * 16)
+    nk = len(H.mp.k)
+    for _ in range(2):
+        H.update_hamiltonian()
+        for k in H.mp.k:
+            for s in range(2):
+                assert np.allclose(H._Hk(k, s), H.H.Hk(k=k, spin=s, format='array'))
+        assert 3 <= len(H._hk_cache) < 2 * nk
+        assert H._hk_cache.memory <= H._hk_cache.max_memory
+        H.random_density()
+    # Changing the hoppings invalidates the stored matrices
+    H.H._csr._D[:, :2] *= 2
+    k = H.mp.k[0]
+    assert np.allclose(H._Hk(k, 0), H.H.Hk(k=k, spin=0, format='array'))
+
+
+def test_checkpoint(tmp_path):
+    fn = str(tmp_path / 'checkpoint.nc')
+
+    def setup():
+        H = hh.HubbardHamiltonian(sp2(sisl.geom.zgnr(2)), U=3., nkpt=[11, 1, 1], kT=0.025)
+        H.set_polarization([0], dn=[-1])
+        return H, sisl.mixing.PulayMixer(weight=0.5, history=5)
+
+    H, mixer = setup()
+    H.converge(density.calc_n, mixer=mixer, tol=1e-10, steps=1, checkpoint=fn)
+    ref = H.n.copy()
+    niter = nc.ncSileHubbard(fn).read_checkpoint()['iteration']
+
+    # Interrupted run, continued with new objects
+    H, mixer = setup()
+    H.converge(density.calc_n, mixer=mixer, tol=1e-10, max_iter=niter // 2, steps=3, checkpoint=fn)
+    H, mixer = setup()
+    H.converge(density.calc_n, mixer=mixer, tol=1e-10, checkpoint=fn, resume=True)
+    assert nc.ncSileHubbard(fn).read_checkpoint()['iteration'] == niter
+    assert np.allclose(H.n, ref)
+
+    # A checkpoint of another system is rejected
+    H = hh.HubbardHamiltonian(sp2(sisl.geom.zgnr(2)), U=2., nkpt=[11, 1, 1], kT=0.025)
+    with pytest.raises(ValueError):
+        H.read_checkpoint(fn)
+
+
+def test_async_writer(tmp_path):
+    fn = str(tmp_path / 'n.nc')
+    H = hh.HubbardHamiltonian(sp2(sisl.geom.zgnr(2)), U=3., nkpt=[11, 1, 1], kT=0.025)
+    H.set_polarization([0], dn=[-1])
+    H.converge(density.calc_n, tol=1e-10, steps=1, fn=fn)
+    # All writes are flushed on return, the last one being the converged density
+    assert np.allclose(nc.ncSileHubbard(fn).read_density(), H.n)
+
+    # and when an exception is raised
+    def calc_n(H, q):
+        if len(calls) == 3:
+            raise RuntimeError
+        calls.append(1)
+        return density.calc_n(H, q)
+    calls = []
+    fn = str(tmp_path / 'n2.nc')
+    H.set_polarization([0], dn=[-1])
+    with pytest.raises(RuntimeError):
+        H.converge(calc_n, tol=1e-10, steps=1, fn=fn)
+    assert np.allclose(nc.ncSileHubbard(fn).read_density(), H.n)
+
+    # Stale writes are coalesced
+    written = []
+    writer = hh._AsyncWriter(maxsize=1)
+    writer.submit('a', time.sleep, 0.2)
+    for i in range(5):
+        writer.submit('b', written.append, i)
+    writer.close()
+    assert written[-1] == 4 and len(written) < 5
+
+
+def test_telemetry(tmp_path):
+    import json
+    fn = str(tmp_path / 'scf.jsonl')
+    H = hh.HubbardHamiltonian(sp2(sisl.geom.zgnr(2)), U=3., nkpt=[11, 1, 1], kT=0.025)
+    H.set_polarization([0], dn=[-1])
+    H.telemetry = hubbard.Telemetry(fn)
+    H.converge(density.calc_n, tol=1e-8, steps=2, fn=str(tmp_path / 'n.nc'))
+    H.telemetry.close()
+    records = H.telemetry.records
+    with open(fn) as f:
+        assert [json.loads(line) for line in f] == records
+    for r in records:
+        assert {'calc_n', 'eigen', 'fermi', 'mixing', 'update', 'total'} <= set(r['time'])
+        assert r['time']['eigen'] + r['time']['fermi'] <= r['time']['calc_n'] <= r['time']['total']
+        assert len(r['Ef']) == 2
+        assert r['mixer']['name'] == 'DIISMixer'
+    assert 'io' in records[1]['time']
+    assert np.isclose(records[-1]['Etot'], H.Etot)
+
+
+def test_iter_converge():
+    H = hh.HubbardHamiltonian(sp2(sisl.geom.zgnr(2)), U=3., nkpt=[11, 1, 1], kT=0.025)
+    H.set_polarization([0], dn=[-1])
+    H.update_hamiltonian()
+    n0 = H.n.copy()
+    states = []
+    for state in H.iter_converge(density.calc_n, tol=1e-8):
+        states.append(state)
+    assert [s.iteration for s in states] == list(range(1, len(states) + 1))
+    assert states[-1].converged and not states[-2].converged
+    assert np.allclose(states[-1].n, H.n)
+
+    # converge with a callback stopping the cycle gives the same iterations
+    H.n = n0
+    H.update_hamiltonian()
+    dn = []
+    H.converge(density.calc_n, tol=1e-8, callbacks=[lambda H, state: dn.append(state.dn),
+                                                    lambda H, state: state.iteration == 5])
+    assert np.allclose(dn, [s.dn for s in states[:5]])
+
+
+@pytest.mark.parametrize('method', ['krylov', 'anderson'])
+def test_solve(method):
+    def zgnr():
+        H = hh.HubbardHamiltonian(sp2(sisl.geom.zgnr(2)), U=3., nkpt=[11, 1, 1], kT=0.025)
+        H.set_polarization([0], dn=[-1])
+        H.update_hamiltonian()
+        return H
+    H, H2 = zgnr(), zgnr()
+    H.converge(density.calc_n, tol=1e-10)
+    assert H2.solve(density.calc_n, method, tol=1e-10) <= 1e-10
+    assert np.allclose(H.n, H2.n, atol=1e-8)
+    assert np.isclose(H.Etot, H2.Etot)
+    with pytest.raises(ValueError):
+        H2.solve(density.calc_n, 'newton')
+
+
+def test_fallback():
+    molecule = sisl.geom.agnr(7).tile(3, 0)
+    molecule.set_nsc([1, 1, 1])
+    H = hh.HubbardHamiltonian(sp2(molecule), U=3.5)
+    np.random.seed(1)
+    H.random_density()
+    H.update_hamiltonian()
+    n0 = H.n.copy()
+    # Linear mixing with weight 1 oscillates between two configurations
+    assert H.converge(density.calc_n_insulator, mixer=sisl.mixing.LinearMixer(1.), max_iter=40) > 0.1
+    H.n = n0
+    H.update_hamiltonian()
+    fallback = hubbard.MixerFallback(['switch'])
+    assert H.converge(density.calc_n_insulator, mixer=sisl.mixing.LinearMixer(1.), max_iter=40, fallback=fallback) < 1e-6
+    assert fallback.log[0]['event'] == 'cycle'
+    assert fallback.log[0]['mixer']['name'] == 'DIISMixer'
+    with pytest.raises(ValueError):
+        hubbard.MixerFallback(['restart'])
+
+    # Rising energy while the densities converge, only the last values are kept
+    fallback = hubbard.MixerFallback(['weight'], window=4)
+    mixer = sisl.mixing.LinearMixer(0.5)
+    for i in range(5):
+        state = hh.SCFState(i + 1, 0.5 ** i, 0.1 * i, n0 + 0.5 ** i, mixer, False)
+        fallback(H, state)
+        assert len(fallback._n) <= 6 and len(fallback._dn) <= 4
+    assert fallback.log[0]['event'] == 'rising'
+    assert mixer.weight == 0.25
+
+
+def test_sweep(tmp_path):
+    def zgnr():
+        H = hh.HubbardHamiltonian(sp2(sisl.geom.zgnr(2)), U=3., nkpt=[11, 1, 1], kT=0.025)
+        H.set_polarization([0], dn=[-1])
+        H.update_hamiltonian()
+        return H
+    fn = str(tmp_path / 'sweep.nc')
+    H = zgnr()
+    U = np.linspace(3, 4, 6)
+    points = H.sweep(density.calc_n, {'U': U, 'kT': [0.025] * 6}, tol=1e-10, fn=fn)
+    assert [p['U'] for p in points] == list(U)
+
+    # The last point agrees with a calculation from scratch
+    H2 = zgnr()
+    H2.U = U[-1]
+    H2.update_hamiltonian()
+    H2.converge(density.calc_n, tol=1e-10)
+    assert np.allclose(points[-1]['n'], H2.n, atol=1e-8)
+    assert np.isclose(points[-1]['Etot'], H2.Etot)
+
+    H2.read_density(fn, group='U=3.2,kT=0.025')
+    assert np.allclose(H2.n, points[1]['n'])
+    with pytest.raises(ValueError):
+        H.sweep(density.calc_n, {'t': [1, 2]})
+
+
+def test_multistart():
+    molecule = sisl.geom.agnr(7).tile(3, 0)
+    molecule.set_nsc([1, 1, 1])
+    H = hh.HubbardHamiltonian(sp2(molecule), U=3.5)
+    solutions = H.multistart(density.calc_n_insulator, starts=8, seed=3, prune=None)
+    assert len(solutions) > 1
+    assert sorted(sum([s['starts'] for s in solutions], [])) == list(range(8))
+    assert all(a['Etot'] <= b['Etot'] for a, b in zip(solutions[:-1], solutions[1:]))
+    assert np.allclose(H.n, solutions[0]['n'])
+
+    # Same results with threads, and pruning discards the starts of the higher solutions
+    threaded = H.multistart(density.calc_n_insulator, starts=8, seed=3, prune=None, executor='thread', max_workers=2)
+    assert [s['starts'] for s in threaded] == [s['starts'] for s in solutions]
+    pruned = H.multistart(density.calc_n_insulator, starts=8, seed=3, prune=0.01, steps=5)
+    assert pruned[0]['starts'] == solutions[0]['starts']
+    assert len(sum([s['starts'] for s in pruned], [])) < 8
+    # Unconverged starts are reported
+    with pytest.warns(UserWarning, match='did not converge'):
+        assert H.multistart(density.calc_n_insulator, starts=2, seed=3, max_iter=2, steps=1) == []
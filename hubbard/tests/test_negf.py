@@ -0,0 +1,109 @@
+import pytest
+import copy
+import numpy as np
+import hubbard.hamiltonian as hh
+import hubbard.sp2 as sp2
+import hubbard.density as density
+import hubbard
+import sisl
+
+
+def device(L=8):
+    H_elec = sp2(sisl.geom.zgnr(2))
+    elec = hh.HubbardHamiltonian(H_elec, U=3., nkpt=[21, 1, 1], kT=0.025)
+    elec.set_polarization([0], dn=[-1])
+    elec.converge(density.calc_n, tol=1e-8)
+    HC = H_elec.tile(L, axis=0)
+    HC.set_nsc([1, 1, 1])
+    H = hh.HubbardHamiltonian(HC.H, n=np.tile(elec.n, L), U=3., kT=0.025)
+    elec_idx = [range(len(H_elec)), range(len(HC) - len(H_elec), len(HC))]
+    return H, elec, elec_idx
+
+
+@pytest.mark.parametrize("solver", ['rgf', 'lu'])
+def test_solver(solver):
+    H, elec, elec_idx = device()
+    dense = hubbard.NEGF(H, [(elec, '-A'), (elec, '+A')], elec_idx, solver='dense')
+    negf = hubbard.NEGF(H, [(elec, '-A'), (elec, '+A')], elec_idx, solver=solver)
+    assert negf.solver == solver
+    if solver == 'rgf':
+        # The blocks partition all device orbitals
+        assert len(negf._solver) > 1
+        assert sorted(np.concatenate(negf._solver.blocks)) == list(range(H.sites))
+
+    HC = H.H.Hk(spin=0, format='array')
+    SE = dense._SE(0, 0, dense._eq_i[0].start + 3)
+    e = dense.CC_eq[0][3]
+    d, cols = dense._G_diag(e, dense._split(HC), SE, columns=(0, 1))
+    d_solver, cols_solver = negf._G_diag(e, negf._split(HC), SE, columns=(0, 1))
+    assert np.allclose(d, d_solver)
+    for c, c_solver in zip(cols, cols_solver):
+        assert np.allclose(c, c_solver)
+
+    n, Etot = dense.calc_n_open(H, H.q)
+    n_solver, Etot_solver = negf.calc_n_open(H, H.q)
+    assert np.allclose(n, n_solver)
+    assert np.isclose(Etot, Etot_solver)
+    with pytest.raises(ValueError):
+        hubbard.NEGF(H, [(elec, '-A'), (elec, '+A')], elec_idx, solver='splu')
+
+    # Electrode orbitals counted from the end of the device
+    negf = hubbard.NEGF(H, [(elec, '-A'), (elec, '+A')], [elec_idx[0], np.arange(-elec.sites, 0)], solver=solver)
+    assert np.allclose(negf._G_diag(e, negf._split(HC), SE)[0], d)
+
+
+def test_batch():
+    H, elec, elec_idx = device(4)
+    negf = hubbard.NEGF(H, [(elec, '-A'), (elec, '+A')], elec_idx, solver='dense', batch_memory=0)
+    HC = H.H.Hk(spin=0, format='array')
+    SE = negf._SE(0, 0, negf._eq_i[0])
+    d = negf._G_diag_batch(negf.CC_eq[0], HC, SE)
+    n, Etot = negf.calc_n_open(H, H.q)
+    # Batches of a few contour points
+    negf.batch_memory = 5 * 3 * 16 * H.sites ** 2
+    assert np.allclose(d, negf._G_diag_batch(negf.CC_eq[0], HC, SE))
+    n_batch, Etot_batch = negf.calc_n_open(H, H.q)
+    assert np.allclose(n, n_batch)
+    assert np.isclose(Etot, Etot_batch)
+
+
+def test_store(tmp_path):
+    H, elec, elec_idx = device(3)
+
+    def elecs():
+        # The electrodes are shifted by their chemical potential
+        return [(copy.deepcopy(elec), '-A'), (copy.deepcopy(elec), '+A')]
+
+    negf = hubbard.NEGF(H, elecs(), elec_idx, V=0.1, solver='dense')
+    nE = 1 + negf.CC_eq.size + len(negf.CC_neq)
+    assert negf._SE.data[0].shape == (H.spin_size, len(H.mp.k), nE, elec.sites, elec.sites)
+    fname = str(tmp_path / 'SE')
+    negf32 = hubbard.NEGF(H, elecs(), elec_idx, V=0.1, solver='dense', SE_dtype=np.complex64, SE_file=fname)
+    assert isinstance(negf32._SE.data[1], np.memmap)
+    assert negf32._SE.nbytes * 2 == negf._SE.nbytes
+    assert np.allclose(np.load(fname + '.1.npy'), negf._SE.data[1], atol=1e-5)
+
+    n, Etot = negf.calc_n_open(H, H.q)
+    n32, Etot32 = negf32.calc_n_open(H, H.q)
+    assert np.allclose(n, n32, atol=1e-4)
+    with pytest.raises(ValueError):
+        hubbard.NEGF(H, elecs(), elec_idx, SE_dtype=np.float64)
+
+
+@pytest.mark.parametrize("executor", ['thread', 'process'])
+def test_executor(executor, tmp_path):
+    H, elec, elec_idx = device(3)
+    negf = hubbard.NEGF(H, [(elec, '-A'), (elec, '+A')], elec_idx)
+    # Processes write the self-energies to the files
+    fname = str(tmp_path / 'SE') if executor == 'process' else None
+    negf_pool = hubbard.NEGF(H, [(elec, '-A'), (elec, '+A')], elec_idx, SE_file=fname, executor=executor, max_workers=2)
+    for SE, SE_pool in zip(negf._SE.data, negf_pool._SE.data):
+        assert np.allclose(SE, SE_pool)
+
+
+def test_no_electrodes():
+    H, _, _ = device(3)
+    negf = hubbard.NEGF(H, [], [])
+    assert negf.solver == 'dense'
+    with pytest.raises(ValueError):
+        hubbard.NEGF(H, [], [], solver='rgf')
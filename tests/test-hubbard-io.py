@@ -32,6 +32,8 @@ for g in fh.groups:
     print('U:', fh.read_U(group=g))
     print('kT:', fh.read_kT(group=g))
     print('\n')
+# Close the file before writing to it again
+fh.close()
 
 print('4. Read using HubbardHamiltoninan class')
 # Read density using the HubbardHamiltonian class with no group specified. It reads from the first one saved